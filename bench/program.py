@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Measures layout programming throughput, on a simulated device by default,
+# or on the first attached keyboard with --usb.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ukbdc_lib.ukbdc import UKBDC, ProgrammedImages
+from ukbdc_lib.emulator import SimulatedDevice, SimulatedTransport
+from ukbdc_lib.layout import Layout, KeyDef
+
+def program_throughput(u, keys, layers, repeat):
+	l = Layout(keys, layers)
+	times = []
+	for i in range(0, repeat):
+		# change a key on every page, so that every page is written
+		for lay in range(0, layers):
+			l[lay, (i + lay) % keys] = KeyDef(scancode = 4 + i % 20)
+		img = l.binary(fordevice = True)
+		start = time.perf_counter()
+		u.program_layout(img, full = True)
+		times.append(time.perf_counter() - start)
+	return len(img), min(times)
+
+def main():
+	ap = argparse.ArgumentParser(description = "Measure layout programming throughput")
+	ap.add_argument("--usb", action = "store_true", help = "use attached device")
+	ap.add_argument("--keys", type = int, default = 65)
+	ap.add_argument("--layers", type = int, default = 16)
+	ap.add_argument("--repeat", type = int, default = 5)
+	ap.add_argument("--packet-size", type = int, default = 64, help = "simulated packet size")
+	ap.add_argument("--latency", type = float, default = 0.0,
+			help = "simulated page write time in seconds")
+	args = ap.parse_args()
+	u = UKBDC(images = ProgrammedImages())
+	if args.usb:
+		u.attach()
+	else:
+		dev = SimulatedDevice(packet_size = args.packet_size,
+				latency = {SimulatedDevice.WRITE_PAGE: args.latency})
+		u.attach(transport = SimulatedTransport(dev))
+	size, t = program_throughput(u, args.keys, args.layers, args.repeat)
+	u.detach()
+	print("%i bytes in %.4f s, %.1f kB/s" % (size, t, size / t / 1000))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Measures import time of the modules used at startup with -X importtime
+# and compares it against a budget. Exits with status 1 if over budget.
+# Optional dependencies have to be installed, or importing them at startup
+# would go unnoticed.
+import argparse
+import ast
+import compileall
+import importlib.util
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# module -> import time budget in ms
+BUDGETS = {
+	"ukbdc_lib": 15.0,
+	"ukbdc_lib.layout": 10.0,
+	"ukbdc_cli": 40.0,
+	# all modules imported by gui.py before its window shows up
+	"gui": 30.0,
+}
+
+OPTIONAL = ["numpy", "usb"]
+
+# gui.py opens its window when imported, so its imports are measured instead
+def gui_modules():
+	with open(os.path.join(ROOT, "gui.py")) as f:
+		tree = ast.parse(f.read())
+	modules = []
+	for node in tree.body:
+		if isinstance(node, ast.Import):
+			modules.extend(alias.name for alias in node.names)
+		elif isinstance(node, ast.ImportFrom) and node.level == 0:
+			modules.append(node.module)
+	return modules
+
+# returns {module: (self us, cumulative us)} for running the import
+# statement, and the names of the modules imported at the top level
+def import_times(statement):
+	# measure loading of the compiled modules, not compiling the sources
+	env = dict(os.environ)
+	env.pop("PYTHONDONTWRITEBYTECODE", None)
+	out = subprocess.run(
+			[sys.executable, "-X", "importtime", "-c", statement],
+			cwd = ROOT, env = env, stderr = subprocess.PIPE,
+			universal_newlines = True, check = True
+	).stderr
+	times = {}
+	top = []
+	for line in out.splitlines():
+		if not line.startswith("import time:") or "self [us]" in line:
+			continue
+		fields = line[len("import time:"):].split("|")
+		name = fields[2].strip()
+		times[name] = (int(fields[0]), int(fields[1]))
+		# nested imports are indented
+		if not fields[2][1:].startswith(" "):
+			top.append(name)
+	return times, top
+
+# cumulative import time (us) of module, or of all modules gui.py imports
+# (except those the interpreter loads at startup anyway)
+def module_time(module, startup):
+	if module != "gui":
+		times, top = import_times("import %s" % module)
+		return times[module][1], times
+	times, top = import_times("import %s" % ", ".join(gui_modules()))
+	return sum(times[name][1] for name in top if name not in startup), times
+
+def main():
+	ap = argparse.ArgumentParser(description = "Measure startup import times")
+	ap.add_argument("--repeat", type = int, default = 5)
+	ap.add_argument("--top", type = int, default = 8, help = "show slowest imports")
+	ap.add_argument("--allow-missing", action = "store_true",
+			help = "measure even if optional dependencies are not installed")
+	args = ap.parse_args()
+	missing = [m for m in OPTIONAL if importlib.util.find_spec(m) is None]
+	if missing:
+		print("optional dependencies not installed: %s" % ", ".join(missing), file = sys.stderr)
+		if not args.allow_missing:
+			return 1
+	compileall.compile_dir(ROOT, quiet = 1)
+	startup = set(import_times("pass")[1])
+	ok = True
+	for module, budget in sorted(BUDGETS.items()):
+		runs = [module_time(module, startup) for i in range(0, args.repeat)]
+		# best of several runs
+		total, best = min(runs, key = lambda r: r[0])
+		total /= 1000.0
+		status = "ok" if total <= budget else "OVER BUDGET"
+		ok = ok and total <= budget
+		print("%-20s %7.2f ms (budget %5.1f ms) %s" % (module, total, budget, status))
+		slowest = sorted(best.items(), key = lambda x: -x[1][0])[:args.top]
+		for name, (self_us, cum_us) in slowest:
+			print("    %-30s self %7.2f ms  cumulative %7.2f ms" % (name, self_us / 1000.0, cum_us / 1000.0))
+	return 0 if ok else 1
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Benchmarks of the layout, protocol and firmware generation hot paths, run
+# without hardware for several layout sizes. Results can be saved as JSON
+# and compared against a saved baseline; exits with status 1 if anything got
+# slower than the baseline by more than the threshold.
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ukbdc_lib.crc16 import crc16
+from ukbdc_lib.layout import Layout, KeyDef, Rel, Abs, PAGE_SIZE
+from ukbdc_lib.ukbdc import UKBDC, ProgrammedImages, WritePage
+from ukbdc_lib.emulator import SimulatedDevice, SimulatedTransport
+from ukbdc_lib import ihex
+
+# Layout with every layer inheriting from the previous one, so that keys of
+# the last layers resolve through long chains. About half of the keys on
+# layers other than the first are inherited.
+def make_layout(keys, layers, seed = 0):
+	rnd = random.Random(seed)
+	l = Layout(keys, layers)
+	l.parents = [-1] + list(range(0, layers - 1))
+	for lay in range(0, layers):
+		for key in range(0, keys):
+			if lay > 0 and rnd.random() < 0.5:
+				l[lay, key] = KeyDef(inherited = True)
+				continue
+			l[lay, key] = KeyDef(scancode = rnd.randrange(4, 232),
+					press = Rel(rnd.randrange(-2, 3)), release = Abs(rnd.randrange(0, 4)))
+	return l
+
+# Each benchmark prepares its data for the given layout size and returns
+# the function to be timed.
+
+def bench_crc16(keys, layers):
+	img = make_layout(keys, layers).binary(fordevice = True)
+	return lambda: crc16(img)
+
+def bench_binary_file(keys, layers):
+	l = make_layout(keys, layers)
+	return lambda: l.binary()
+
+def bench_binary_device(keys, layers):
+	l = make_layout(keys, layers)
+	data = l.binary()
+	return lambda: Layout.from_binary(data).binary(fordevice = True)
+
+def bench_binary_device_edit(keys, layers):
+	l = make_layout(keys, layers)
+	kds = [KeyDef(scancode = 4), KeyDef(scancode = 5)]
+	state = {"i": 0}
+	def run():
+		i = state["i"] = state["i"] + 1
+		# a key of the first layer is inherited by the keys of all other layers
+		l[0, i % keys] = kds[i & 1]
+		return l.binary(fordevice = True)
+	return run
+
+def bench_from_binary(keys, layers):
+	data = make_layout(keys, layers).binary()
+	return lambda: Layout.from_binary(data)
+
+def bench_framing(keys, layers):
+	img = make_layout(keys, layers).binary(fordevice = True)
+	pages = [img[i:i+PAGE_SIZE] for i in range(0, len(img), PAGE_SIZE)]
+	def run():
+		for no, page in enumerate(pages):
+			msg = WritePage(no, page)
+			msg.set_packet_size(64)
+			for packet in msg:
+				pass
+	return run
+
+def bench_hex_generate(keys, layers):
+	rnd = random.Random(1)
+	firmware = ihex.HexImage([(0, bytes(rnd.getrandbits(8) for i in range(0, 0x2700)))])
+	img = make_layout(keys, layers).binary(fordevice = True)
+	return lambda: firmware.patched(0x2700, img).write(io.StringIO())
+
+def bench_hex_parse(keys, layers):
+	rnd = random.Random(1)
+	firmware = ihex.HexImage([(0, bytes(rnd.getrandbits(8) for i in range(0, 0x2700)))])
+	img = make_layout(keys, layers).binary(fordevice = True)
+	lines = list(firmware.patched(0x2700, img).records())
+	return lambda: ihex.HexImage.parse(lines)
+
+def bench_keydef_access(keys, layers):
+	l = make_layout(keys, layers)
+	last = layers - 1
+	def run():
+		for key in range(0, keys):
+			kd = l[last, key]
+			kd.scancode, kd.press, kd.release, kd.inherited
+	return run
+
+def bench_program_layout(keys, layers):
+	img = make_layout(keys, layers).binary(fordevice = True)
+	dev = SimulatedDevice(no_pages = (len(img) + PAGE_SIZE - 1) // PAGE_SIZE)
+	u = UKBDC(images = ProgrammedImages())
+	u.attach(transport = SimulatedTransport(dev))
+	return lambda: u.program_layout(img, full = True)
+
+BENCHMARKS = [
+	("crc16", bench_crc16),
+	("binary_file", bench_binary_file),
+	("binary_device", bench_binary_device),
+	("binary_device_edit", bench_binary_device_edit),
+	("from_binary", bench_from_binary),
+	("framing", bench_framing),
+	("hex_generate", bench_hex_generate),
+	("hex_parse", bench_hex_parse),
+	("keydef_access", bench_keydef_access),
+	("program_layout", bench_program_layout),
+]
+
+# seconds per call, best of repeat runs of at least 0.2 s each
+def measure(fn, repeat):
+	timer = timeit.Timer(fn)
+	number = timer.autorange()[0]
+	return min(timer.repeat(repeat = repeat, number = number)) / number
+
+def parse_size(s):
+	keys, layers = s.lower().split("x")
+	return int(keys), int(layers)
+
+def compare(results, baseline, threshold):
+	regressions = []
+	for name in sorted(results):
+		if name not in baseline:
+			continue
+		ratio = results[name] / baseline[name]
+		flag = ""
+		if ratio > 1 + threshold:
+			flag = "REGRESSION"
+			regressions.append(name)
+		elif ratio < 1 - threshold:
+			flag = "faster"
+		print("%-36s %10.2f us %10.2f us %6.2fx %s" %
+				(name, baseline[name] * 1e6, results[name] * 1e6, ratio, flag))
+	return regressions
+
+def main():
+	ap = argparse.ArgumentParser(description = "Benchmark layout, protocol and firmware code")
+	ap.add_argument("--sizes", default = "65x16,128x32,255x32",
+			help = "comma separated KEYSxLAYERS layout sizes")
+	ap.add_argument("--repeat", type = int, default = 5)
+	ap.add_argument("--filter", help = "run only benchmarks with names containing this")
+	ap.add_argument("--json", help = "write results to this file (- for stdout)")
+	ap.add_argument("--compare", help = "baseline results file to compare against")
+	ap.add_argument("--threshold", type = float, default = 0.10,
+			help = "relative slowdown reported as a regression")
+	args = ap.parse_args()
+	sizes = [parse_size(s) for s in args.sizes.split(",")]
+	results = {}
+	for name, bench in BENCHMARKS:
+		if args.filter is not None and args.filter not in name:
+			continue
+		for keys, layers in sizes:
+			full_name = "%s[%ix%i]" % (name, keys, layers)
+			results[full_name] = measure(bench(keys, layers), args.repeat)
+			if args.compare is None:
+				print("%-36s %10.2f us" % (full_name, results[full_name] * 1e6), file = sys.stderr)
+	if args.json is not None:
+		out = {
+			"python": platform.python_version(),
+			"machine": platform.machine(),
+			"results": results,
+		}
+		if args.json == "-":
+			json.dump(out, sys.stdout, indent = 1, sort_keys = True)
+			print()
+		else:
+			with open(args.json, "w") as f:
+				json.dump(out, f, indent = 1, sort_keys = True)
+	if args.compare is not None:
+		with open(args.compare, "r") as f:
+			baseline = json.load(f)["results"]
+		print("%-36s %13s %13s" % ("benchmark", "baseline", "current"))
+		regressions = compare(results, baseline, args.threshold)
+		if regressions:
+			print("%i regression(s)" % len(regressions))
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
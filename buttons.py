@@ -42,3 +42,19 @@ class Buttons(dict):
 
 	def add_button(self, no, width, height, x, y):
 		self[no] = Button(width, height, x, y)
+
+	# reads keyboard geometry from an xml file
+	@staticmethod
+	def from_xml(fname):
+		import xml.etree.ElementTree as ET
+		keyboard = ET.parse(fname).getroot()
+		w = int(keyboard.attrib['width'])
+		h = int(keyboard.attrib['height'])
+		num_keys = int(keyboard.attrib['num_keys'])
+		buttons = Buttons(num_keys, w, h)
+		for key in keyboard:
+			no = int(key.attrib['id'])
+			buttons.add_button(no,
+					int(key.attrib['width']), int(key.attrib['height']),
+					int(key.attrib['x']), int(key.attrib['y']))
+		return buttons
@@ -2,19 +2,51 @@
 from tkinter import *
 from tkinter.filedialog import *
 from tkinter.messagebox import *
+from tkinter.ttk import Progressbar
+import os
 import sys
-import xml.etree.ElementTree as ET
-import hashlib
+import queue
+import threading
 
 from ukbdc_lib.layout import *
-from ukbdc_lib import UKBDC, USBError
-from ukbdc_lib.mnemonics import mnemonics
+from ukbdc_lib import UKBDC, Cancelled
+from ukbdc_lib.metrics import MetricsRecorder
+from ukbdc_lib.history import History
+from ukbdc_lib.autosave import Autosave
+from ukbdc_lib.firmware import BASE_FIRMWARE, read_firmware, firmware_sha1, write_firmware
+from ukbdc_lib.mnemonics import mnemonics, scancodes, Completer
 
 from buttons import Buttons
 
 def platform_windows():
 	return sys.platform.startswith("win")
 
+# returns label for an action (relative or absolute)
+def action_label(prefix, action):
+	try:
+		arg = str(action.arg)
+	except ValueError:
+		arg = ""
+	if action.kind == Action.Rel:
+		if action.arg >= 0:
+			s = "+" + arg
+		else:
+			s = arg
+		n = s
+	elif action.kind == Action.Abs:
+		n = arg
+	else:
+		n = ""
+	if n == "":
+		return ""
+	else:
+		return prefix + n
+
+# what a key looks like on screen, used to skip redrawing unchanged keys
+def key_state(kd):
+	return (kd.nicename, kd.inherited,
+			action_label("↓", kd.press), action_label("↑", kd.release))
+
 class KeyButton(Button):
 	_fgcol    = "black"   # text color
 	_inhfgcol = "#999999" # text color if inherited
@@ -87,36 +119,15 @@ class KeyButton(Button):
 		for label in self._.values():
 			label.config(bg = color)
 
-	# returns label for an action (relative or absolute)
-	def _generate_label(self, prefix, action):
-		try:
-			arg = str(action.arg)
-		except ValueError:
-			arg = ""
-		if action.kind == Action.Rel:
-			if action.arg >= 0:
-				s = "+" + arg
-			else:
-				s = arg
-			n = s
-		elif action.kind == Action.Abs:
-			n = arg
-		else:
-			n = ""
-		if n == "":
-			return ""
-		else:
-			return prefix + n
-
 	def _update_press_label(self, action, inherited):
-		self._['l_pr'].config(text = self._generate_label("↓", action))
+		self._['l_pr'].config(text = action_label("↓", action))
 		if inherited:
 			self._['l_pr'].config(fg = self._inhfgcol)
 		else:
 			self._['l_pr'].config(fg = self._prcol)
 
 	def _update_release_label(self, action, inherited):
-		self._['l_re'].config(text = self._generate_label("↑", action))
+		self._['l_re'].config(text = action_label("↑", action))
 		if inherited:
 			self._['l_re'].config(fg = self._inhfgcol)
 		else:
@@ -153,7 +164,44 @@ class KeyButton(Button):
 		self._update_press_label(kd.press, kd.inherited)
 		self._update_release_label(kd.release, kd.inherited)
 
-class KeyboardFrame(Frame):
+# Collapses bursts of <Configure> events (e.g. while the window is dragged):
+# _relayout(width, height) runs at most once per _resize_delay ms, and only
+# if the size differs from the one laid out last. relayouts and
+# resize_events count how many of each happened.
+class ResizeThrottle(object):
+	_resize_delay = 20
+
+	def _init_resize(self, widget):
+		self.relayouts = 0
+		self.resize_events = 0
+		self._resize_pending = None
+		self._size = None
+		self._laid_out_size = None
+		widget.bind("<Configure>", self._on_configure)
+
+	def _on_configure(self, event):
+		self.resize_events += 1
+		self._size = (event.width, event.height)
+		self._schedule_relayout()
+
+	def _schedule_relayout(self):
+		if self._resize_pending is None and self._size is not None:
+			self._resize_pending = self.after(self._resize_delay, self._do_relayout)
+
+	def _do_relayout(self):
+		self._resize_pending = None
+		if self._size == self._laid_out_size:
+			return
+		self._laid_out_size = self._size
+		self.relayouts += 1
+		self._relayout(*self._size)
+
+	# lays out again even if the size did not change
+	def _invalidate_layout(self):
+		self._laid_out_size = None
+		self._schedule_relayout()
+
+class KeyboardFrame(Frame, ResizeThrottle):
 	# on_button_pressed will receive the button number
 	# or Null if a button was deselected
 	def __init__(self, master, on_button_pressed):
@@ -161,21 +209,23 @@ class KeyboardFrame(Frame):
 		self._ = {}
 		self._button_callback = on_button_pressed
 		self._cur_button = None
-		# initialize actual keyboard dimensions to (1, 1),
-		# because we don't know the dimensions yet
+		self._bdefs = None
+		self._shown = {} # key number -> key_state currently displayed
 		self.bind("<Button-1>", self._on_click_nothing)
-		self.bind("<Configure>", self._on_change_size)
+		self._init_resize(self)
 		self._['f_cont'] = Frame(self)
 
 	# set keyboard containter size to a fixed ratio, and fill the frame with it
-	def _on_change_size(self, event):
+	def _relayout(self, width, height):
+		if self._bdefs is None or width <= 0 or height <= 0:
+			return
 		ratio = float(self._bdefs.width) / self._bdefs.height
-		myratio = float(self.winfo_width()) / self.winfo_height()
+		myratio = float(width) / height
 		if myratio > ratio:
-			h = self.winfo_height()
+			h = height
 			w = h * ratio
 		else:
-			w = self.winfo_width()
+			w = width
 			h = w / ratio
 		self._['f_cont'].place(
 				anchor = CENTER,
@@ -197,8 +247,14 @@ class KeyboardFrame(Frame):
 	# Public API starts here...
 
 	def update_button(self, no, kd):
+		state = key_state(kd)
+		if self._shown.get(no) == state:
+			return
+		self._shown[no] = state
 		b = self._get_btn_widget(no)
 		b.set_keydef(kd)
+		if platform_windows():
+			b._layout_labels()
 
 	def get_current_btn(self):
 		if self._cur_button is None:
@@ -236,6 +292,156 @@ class KeyboardFrame(Frame):
 					relheight = float(button.height) / btns.height
 			)
 			self._['b_%i' % no] = widget
+		self._invalidate_layout()
+
+# Draws all keys on a single canvas instead of using a widget per key.
+# Public API is the same as KeyboardFrame's.
+class CanvasKeyboardFrame(Frame, ResizeThrottle):
+	_fgcol    = KeyButton._fgcol
+	_inhfgcol = KeyButton._inhfgcol
+	_prcol    = KeyButton._prcol
+	_recol    = KeyButton._recol
+	_nocol    = KeyButton._nocol
+	_hibgcol  = KeyButton._hibgcol
+	_ahibgcol = KeyButton._ahibgcol
+	_labfont  = KeyButton._labfont
+	_inhbgcol = "#c4c4c4" # background color if inherited (sunken)
+	_outcol   = "#808080" # key border color
+	_pad      = 2         # space between keys in pixels
+
+	def __init__(self, master, on_button_pressed):
+		super(CanvasKeyboardFrame, self).__init__(master)
+		self._button_callback = on_button_pressed
+		self._cur_button = None
+		self._hover = None
+		self._bdefs = None
+		self._items = {}   # key number -> dict of canvas items
+		self._keys = {}    # canvas item -> key number
+		self._inherited = {}
+		self._shown = {}   # key number -> key_state currently displayed
+		# take key colors from the default button look
+		b = Button(self)
+		self._bgcol = b.cget("bg")
+		self._abgcol = b.cget("activebackground")
+		b.destroy()
+		self._canvas = Canvas(self, highlightthickness = 0)
+		self._canvas.pack(fill = BOTH, expand = True)
+		self._init_resize(self._canvas)
+		self._canvas.bind("<Button-1>", self._on_click)
+		self._canvas.bind("<Motion>", self._on_motion)
+		self._canvas.bind("<Leave>", lambda e: self._set_hover(None))
+
+	def _key_at(self, event):
+		items = self._canvas.find_overlapping(event.x, event.y, event.x, event.y)
+		for item in reversed(items):
+			if item in self._keys:
+				return self._keys[item]
+		return None
+
+	def _on_click(self, event):
+		no = self._key_at(event)
+		if no is not None:
+			self._button_callback(no)
+		elif self._cur_button is not None:
+			self._button_callback(None)
+
+	def _on_motion(self, event):
+		self._set_hover(self._key_at(event))
+
+	def _set_hover(self, no):
+		if no == self._hover:
+			return
+		old, self._hover = self._hover, no
+		for n in (old, no):
+			if n is not None:
+				self._paint(n)
+
+	def _paint(self, no):
+		if no == self._cur_button:
+			col = self._ahibgcol if no == self._hover else self._hibgcol
+		elif self._inherited.get(no, False):
+			col = self._inhbgcol
+		else:
+			col = self._abgcol if no == self._hover else self._bgcol
+		self._canvas.itemconfig(self._items[no]['rect'], fill = col)
+
+	# place all keys at the largest scale which keeps the keyboard's ratio
+	def _relayout(self, width, height):
+		if self._bdefs is None:
+			return
+		btns = self._bdefs
+		scale = min(float(width) / btns.width, float(height) / btns.height)
+		ox = (width - btns.width * scale) / 2
+		oy = (height - btns.height * scale) / 2
+		c = self._canvas
+		p = self._pad / 2.0
+		for no, b in btns.items():
+			x0, y0 = ox + b.x * scale + p, oy + b.y * scale + p
+			x1, y1 = x0 + b.width * scale - 2*p, y0 + b.height * scale - 2*p
+			it = self._items[no]
+			c.coords(it['rect'], x0, y0, x1, y1)
+			c.coords(it['text'], (x0 + x1) / 2, (y0 + y1) / 2)
+			c.coords(it['l_no'], x0 + 2, y0 + 1)
+			c.coords(it['l_pr'], x0 + 2, y1 - 1)
+			c.coords(it['l_re'], x1 - 2, y1 - 1)
+
+	# Public API starts here...
+
+	def update_button(self, no, kd):
+		state = key_state(kd)
+		if self._shown.get(no) == state:
+			return
+		self._shown[no] = state
+		name, inh, prlabel, relabel = state
+		it = self._items[no]
+		c = self._canvas
+		c.itemconfig(it['text'], text = name, fill = self._inhfgcol if inh else self._fgcol)
+		c.itemconfig(it['l_no'], fill = self._inhfgcol if inh else self._nocol)
+		c.itemconfig(it['l_pr'], text = prlabel, fill = self._inhfgcol if inh else self._prcol)
+		c.itemconfig(it['l_re'], text = relabel, fill = self._inhfgcol if inh else self._recol)
+		if self._inherited.get(no) != inh:
+			self._inherited[no] = inh
+			self._paint(no)
+
+	def get_current_btn(self):
+		return self._cur_button
+
+	def set_current_btn(self, no):
+		old, self._cur_button = self._cur_button, no
+		for n in (old, no):
+			if n is not None:
+				self._paint(n)
+
+	def next_button(self):
+		if self._cur_button is None:
+			return
+		nos = sorted(self._bdefs.keys())
+		pos = nos.index(self._cur_button) + 1
+		if pos >= len(nos):
+			pos = 0
+		self._button_callback(nos[pos])
+
+	def setup_buttons(self, btns):
+		self._bdefs = btns
+		c = self._canvas
+		c.delete(ALL)
+		self._items = {}
+		self._keys = {}
+		self._inherited = {}
+		self._shown = {}
+		for no in btns.keys():
+			it = {
+				'rect': c.create_rectangle(0, 0, 0, 0, fill = self._bgcol, outline = self._outcol),
+				'text': c.create_text(0, 0, anchor = CENTER),
+				'l_no': c.create_text(0, 0, anchor = NW, text = str(no),
+						fill = self._nocol, font = self._labfont),
+				'l_pr': c.create_text(0, 0, anchor = SW, fill = self._prcol, font = self._labfont),
+				'l_re': c.create_text(0, 0, anchor = SE, fill = self._recol, font = self._labfont)
+			}
+			self._items[no] = it
+			for item in it.values():
+				self._keys[item] = no
+		self._invalidate_layout()
 
 # A decorator which switches off notifications before the function is called to prevent
 # notifications in functions which set Tkinter variables
@@ -393,6 +599,7 @@ class ScancodeEntry(Frame):
 		self._['l_hints'] = Label(self)
 		self._['l_hints'].grid(column = 1, row = 0)
 		self._hints = []
+		self._completer = Completer()
 		self._mnemonic = ""
 		self._should_notify = True
 
@@ -409,13 +616,12 @@ class ScancodeEntry(Frame):
 			self._['e_mnemonic'].config(bg = self._correct_bgcolor)
 			self._mnemonic = self._mnemonic_var.get()
 		if len(self._mnemonic_var.get()) == 0:
-			self._hints = []
+			hints = []
 		else:
-			self._hints = list(filter(
-					lambda x: x.startswith(self._mnemonic_var.get()),
-					mnemonics.values())
-			)
-		self._['l_hints'].config(text = " ".join(self._hints))
+			hints = self._completer.complete(self._mnemonic_var.get())
+		if hints != self._hints:
+			self._hints = hints
+			self._['l_hints'].config(text = " ".join(self._hints))
 		if self._mnemonic_correct:
 			self._notify()
 
@@ -430,8 +636,7 @@ class ScancodeEntry(Frame):
 			except ValueError:
 				return False
 		else:
-			valid_mnemonics = mnemonics.values()
-			return text in valid_mnemonics
+			return text in scancodes
 
 	def _notify(self):
 		if self._should_notify:
@@ -566,14 +771,81 @@ class PropsFrame(Frame):
 		else:
 			self.moderadios[1].config(state = DISABLED)
 
+# Programs a layout image in a background thread. Progress and the result
+# are passed to the Tk thread as events in a queue.
+class ProgramJob(object):
+	def __init__(self, image, full):
+		self.image = image
+		self.full = full
+		self.cancel = threading.Event()
+		self.events = queue.Queue()
+		self.metrics = MetricsRecorder()
+		self._thread = threading.Thread(target = self._run, daemon = True)
+
+	def start(self):
+		self._thread.start()
+
+	def _progress(self, done, total):
+		self.events.put(("progress", done, total))
+
+	# transfer rate of the pages written, None if nothing was written
+	@property
+	def rate(self):
+		h = self.metrics.histograms.get("program_bytes_per_s")
+		return None if h is None else h.max
+
+	def _run(self):
+		u = UKBDC(metrics = self.metrics)
+		try:
+			try:
+				u.attach()
+				skipped = u.program_layout(self.image, full = self.full,
+						progress = self._progress, cancel = self.cancel)
+			finally:
+				# attach() may fail after the interface is claimed
+				if u.transport is not None:
+					u.detach()
+			self.events.put(("done", skipped))
+		except Cancelled:
+			self.events.put(("cancelled",))
+		except Exception as e:
+			self.events.put(("error", e))
+
+# Programs a layout image to all attached devices, see multi.program_all.
+# Progress is counted in devices and the result is a list of ProgramResults.
+class ProgramAllJob(ProgramJob):
+	def _run(self):
+		try:
+			# loaded when used, it takes a while (see bench/startup.py)
+			from ukbdc_lib.multi import program_all
+			results = program_all(self.image, full = self.full, metrics = self.metrics,
+					progress = self._progress, cancel = self.cancel)
+			self.events.put(("done_all", results))
+		except Exception as e:
+			self.events.put(("error", e))
+
 class MainWindow:
-	def __init__(self, master, buttons):
+	# how often (ms) to check for progress of programming
+	_poll_interval = 50
+	# memory (bytes) the undo history may take
+	undo_memory = 1 << 20
+	# where edits are autosaved, None disables autosave
+	autosave_dir = os.path.join(os.path.expanduser("~"), ".ukbdc_gui", "autosave")
+	# use_canvas selects the single-canvas keyboard renderer
+	def __init__(self, master, buttons, use_canvas = False):
 		# FIXME: read params from xml...
 		self.buttons = buttons
 		self.btn_nos = buttons.nos
 		self.cur_filename = None
 		self.modified = False
+		self.program_job = None
+		# exit requested, waiting for program_job to stop
+		self.exiting = False
 		self.layout = Layout(buttons.num_keys, 16)
+		self.history = None
+		self.autosave = None
+		if self.autosave_dir is not None:
+			self.autosave = Autosave(self.autosave_dir)
 		master.wm_geometry("800x600+0+0")
 		self.master = master
 		self.menu = MainMenu(master, self.on_menu_action)
@@ -614,6 +886,7 @@ class MainWindow:
 		self.inh.set("none")
 		self.inhopt = OptionMenu(f, self.inh, "none", command = self.on_change_inh)
 		self.inhopt.pack(side = LEFT)
+		self.inh_opts = ["none"]
 		self.layprops = f
 		i = TooltipButton(f, text = "inherit all", tooltip = "Make all keys on this layer inherited", statusbar = self.status,
 				command = self.on_inherit_button_clicked)
@@ -624,35 +897,107 @@ class MainWindow:
 
 		self.bottomframe.pack(side = BOTTOM, fill = BOTH)
 
-		self.kbframe = KeyboardFrame(master, self.on_key_chosen)
+		if use_canvas:
+			self.kbframe = CanvasKeyboardFrame(master, self.on_key_chosen)
+		else:
+			self.kbframe = KeyboardFrame(master, self.on_key_chosen)
 		self.kbframe.pack(side = TOP, fill = BOTH, expand = True)
 		master.bind("<Escape>", lambda x: self.on_key_chosen(None))
 
 		self.kbframe.setup_buttons(buttons)
 
 		master.bind("<Control-Return>", lambda x: self.kbframe.next_button())
+		master.bind("<Control-z>", lambda x: self.on_menu_action("undo"))
+		master.bind("<Control-y>", lambda x: self.on_menu_action("redo"))
 
 		self.props = PropsFrame(self.bottomframe,
 				notify = self.on_props_changed,
 				next_button = self.kbframe.next_button
 		)
+		recovered = self.recover_autosave()
+		self.track_layout()
+		for d in recovered:
+			# the recovered changes are autosaved again by now, unless autosave failed
+			if self.history.observer is not None:
+				Autosave.remove(d)
+			else:
+				Autosave.release(d)
 		self.on_change_layer(self.layer.get())
 
+	# Offers to recover changes autosaved by editors which didn't exit
+	# cleanly. Returns the directories of the sessions dealt with, to be
+	# removed once the current layout is autosaved.
+	def recover_autosave(self):
+		done = []
+		if self.autosave is None:
+			return done
+		for d in Autosave.abandoned(self.autosave_dir):
+			rec = Autosave.recover(d)
+			if rec is None:
+				done.append(d)
+			elif self.modified:
+				# one session was recovered already, offer this one next time
+				Autosave.release(d)
+			else:
+				done.append(d)
+				if askyesno("Recover layout?", "The editor was not closed properly. Recover unsaved changes?"):
+					self.layout, self.cur_filename = rec
+					self.modified = True
+					self.status.set("Recovered unsaved changes")
+					if self.cur_filename is not None:
+						self.set_save_state(True)
+		return done
+
+	# starts undo history and autosave of a newly loaded layout
+	def track_layout(self):
+		self.history = History(self.layout, self.undo_memory)
+		self.restart_autosave()
+
+	# autosaves self.layout from its current state on
+	def restart_autosave(self):
+		if self.autosave is None:
+			return
+		try:
+			self.autosave.start(self.layout, self.cur_filename)
+			self.history.observer = self.autosave
+		except OSError as e:
+			self.history.observer = None
+			self.status.set("Autosave disabled: %s" % str(e))
+
 	def on_inherit_button_clicked(self):
 		ans = askyesno("Inherit all keys?", "All key definitions on this layer will be lost. Are you sure?")
 		if not ans:
 			return
-		for i in self.btn_nos :
-			b = self.layout[self.layer.get(), i]
-			b.inherited = True
-			self.kbframe.update_button(i, b)
-			self.props.load_keydef(b)
+		lay = self.layer.get()
+		with self.history.group("inherit all"):
+			for i in self.btn_nos:
+				self.history.set_record(lay, i, INHERITED)
+		for i in self.btn_nos:
+			self.kbframe.update_button(i, self.layout[lay, i])
+		self.on_key_chosen(self.kbframe.get_current_btn())
+		self.modified = True
+		self.status.set("Layout modified")
+		if self.cur_filename is not None:
+			self.set_save_state(True)
 
 	def on_exit(self):
+		if self.exiting:
+			return
 		if self.modified:
 			cont = self.ask_save()
 			if not cont:
 				return
+		if self.program_job is not None:
+			# quit once the job stops, see _poll_programming
+			self.exiting = True
+			self.program_job.cancel.set()
+			self.status.set("Cancelling programming before exit...")
+			return
+		self.quit()
+
+	def quit(self):
+		if self.autosave is not None:
+			self.autosave.discard()
 		self.master.quit()
 
 	def place_frames(self):
@@ -684,7 +1029,8 @@ class MainWindow:
 			lay = -1
 		else:
 			lay = int(lay)
-		self.layout.parents[self.layer.get()] = lay
+		with self.history.group("change parent"):
+			self.history.set_parent(self.layer.get(), lay)
 		self.on_change_layer(self.layer.get())
 		self.modified = True
 		self.status.set("Layout modified")
@@ -698,7 +1044,8 @@ class MainWindow:
 			kd = KeyDef(layout = self.layout, no = cur_no, layer = self.layer.get(),
 					inherited = True)
 		self.kbframe.update_button(cur_no, kd)
-		self.layout[self.layer.get(), cur_no] = kd
+		with self.history.group("edit key"):
+			self.history[self.layer.get(), cur_no] = kd
 		self.modified = True
 		self.status.set("Layout modified")
 		if self.cur_filename is not None:
@@ -717,21 +1064,45 @@ class MainWindow:
 				pass
 		# reload button props on the new layer
 		self.on_key_chosen(self.kbframe.get_current_btn())
-		if platform_windows():
-			for b in self.btn_nos:
-				self.kbframe._get_btn_widget(b)._layout_labels()
-		self.inhopt.pack_forget()
 		opts = [str(i) for i in range(0, l)]
 		if l == 0:
 			opts = ["none"] + opts
-		self.inhopt = OptionMenu(self.layprops, self.inh, *opts, command = self.on_change_inh)
-		self.inhopt.pack(side = LEFT)
+		self.set_inh_options(opts)
 		if self.layout.parents[l] == -1:
 			self.inh.set("none")
 		else:
 			self.inh.set(str(self.layout.parents[l]))
 		self.props.set_inheritable(self.inh.get() != "none")
 
+	# Updates the display after an edit was undone or redone: only the
+	# buttons of the keys it changed, unless parents changed
+	def refresh_edit(self, edit):
+		l = self.layer.get()
+		if edit.parents:
+			self.on_change_layer(l)
+			return
+		nos = edit.key_nos
+		for b in self.btn_nos:
+			if b in nos:
+				self.kbframe.update_button(b, self.layout[l, b])
+		cur = self.kbframe.get_current_btn()
+		if cur in nos:
+			self.props.load_keydef(self.layout[l, cur])
+
+	# replaces entries of the "inherits from" menu, if they differ
+	def set_inh_options(self, opts):
+		if opts == self.inh_opts:
+			return
+		self.inh_opts = opts
+		menu = self.inhopt["menu"]
+		menu.delete(0, END)
+		for o in opts:
+			menu.add_command(label = o, command = lambda o = o: self.on_inh_selected(o))
+
+	def on_inh_selected(self, lay):
+		self.inh.set(lay)
+		self.on_change_inh(lay)
+
 	def on_add_layer(self):
 		pass
 
@@ -753,6 +1124,7 @@ class MainWindow:
 				self.cur_filename = fname
 				self.set_save_state(False)
 				self.modified = False
+				self.restart_autosave()
 			except Exception as e:
 				self.status.set("Failed to write file %s: %s!" % (fname, str(e)))
 		elif cmd == "save":
@@ -763,6 +1135,7 @@ class MainWindow:
 				self.status.set("Saved.")
 				self.set_save_state(False)
 				self.modified = False
+				self.restart_autosave()
 			except Exception as e:
 				self.status.set("Failed to write file %s: %s!" % (fname, str(e)))
 		elif cmd == "open":
@@ -779,9 +1152,10 @@ class MainWindow:
 				f = open(fname, "rb")
 				data = f.read()
 				self.layout = Layout.from_binary(data)
+				self.cur_filename = fname
+				self.track_layout()
 				self.layer.set(0)
 				self.on_change_layer(0)
-				self.cur_filename = fname
 				self.set_save_state(False)
 				self.on_key_chosen(None)
 				self.status.set("Opened file: %s" % fname)
@@ -797,6 +1171,7 @@ class MainWindow:
 			self.layer.set(0)
 			self.on_change_layer(0)
 			self.cur_filename = None
+			self.track_layout()
 			self.set_save_state(False)
 			self.status.set("Created new layout")
 		elif cmd == "generate":
@@ -805,49 +1180,98 @@ class MainWindow:
 			)
 			if fname == "":
 				return
-			fi = "base_firmware.hex"
+			fi = BASE_FIRMWARE
 			try:
-				f = open(fi, "r")
-				firmware = f.readlines()
-				f.close()
+				firmware = read_firmware(fi)
 			except Exception as e:
 				self.status.set("Failed to read firmware file %s: %s!" % (fi, str(e)))
-			blob = "".join(firmware)
-			h = hashlib.sha1(bytes(blob, encoding="utf-8")).hexdigest()
+				return
+			h = firmware_sha1(firmware)
 			#if h != "22b1fdf1bbf6b8dce8d9a5ba3bf91f842ec067f8":
 			#	self.status.set("Corrupted firmware file %s!" % fi)
 			#	return
 
-			b = self.layout.binary(fordevice = True)
-			chunks = [b[i:i+16] for i in range(0, len(b), 16)]
-			lines = []
-			for i, chunk in enumerate(chunks):
-				data = "".join(map(lambda b: "%.2X" % b, chunk))
-				addr = 0x2700+16*i
-				chksum = ((((sum(chunk)+len(chunk)+(addr&0xFF)+(addr>>8)) & 0xFF) ^ 0xFF) + 1) & 0xFF
-				l = ":%.2X%.4X00%s%.2X\n" % (len(chunk), addr, data, chksum)
-				lines.append(l)
-			output = firmware[:-1] + lines + [firmware[-1]]
-			output = "".join(output)
 			try:
-				f = open(fname, "w")
-				f.write(output)
-				f.close()
+				write_firmware(fname, firmware, self.layout.binary(fordevice = True))
 				self.status.set("Generated firmware %s." % fname)
+			except ValueError as e:
+				self.status.set("Failed to generate firmware: %s!" % str(e))
 			except Exception as e:
 				self.status.set("Failed to write file %s: %s!" % (fname, str(e)))
+		elif cmd == "undo" or cmd == "redo":
+			if cmd == "undo":
+				edit = self.history.undo()
+			else:
+				edit = self.history.redo()
+			if edit is None:
+				self.status.set("Nothing to %s" % cmd)
+				return
+			self.refresh_edit(edit)
+			self.modified = True
+			self.status.set("%s %s" % ("Undone" if cmd == "undo" else "Redone", edit.label))
+			if self.cur_filename is not None:
+				self.set_save_state(True)
 		elif cmd == "exit":
 			self.on_exit()
-		elif cmd == "program":
-			u = UKBDC()
-			try:
-				binary = self.layout.binary(fordevice = True)
-				u.attach()
-				u.program_layout(binary)
-				u.detach()
-				self.status.set("Programmed %i bytes of layout" % len(binary))
-			except USBError as e:
-				self.status.set("Programming error: %s" % str(e))
+		elif cmd == "program" or cmd == "program_full":
+			self.start_programming(full = cmd == "program_full")
+		elif cmd == "program_all":
+			self.start_programming(full = False, job_class = ProgramAllJob)
+
+	def start_programming(self, full, job_class = ProgramJob):
+		if self.program_job is not None:
+			return
+		self.program_job = job_class(self.layout.binary(fordevice = True), full)
+		self.status.start_progress(on_cancel = self.program_job.cancel.set)
+		self.status.set("Programming...")
+		self.program_job.start()
+		self.master.after(self._poll_interval, self._poll_programming)
+
+	def _poll_programming(self):
+		job = self.program_job
+		finished = False
+		try:
+			while not finished:
+				ev = job.events.get_nowait()
+				finished = ev[0] != "progress"
+				if ev[0] == "progress":
+					self.status.set_progress(ev[1], ev[2])
+					if isinstance(job, ProgramAllJob):
+						self.status.set("Programmed %i of %i devices..." % (ev[1], ev[2]))
+					else:
+						self.status.set("Programming page %i of %i..." % (ev[1], ev[2]))
+				elif ev[0] == "done":
+					rate = "" if job.rate is None else ", %.1f kB/s" % (job.rate / 1000)
+					self.status.set("Programmed %i bytes of layout (%i unchanged pages skipped%s)" %
+							(len(job.image), ev[1], rate))
+				elif ev[0] == "done_all":
+					self.report_program_all(ev[1])
+				elif ev[0] == "cancelled":
+					self.status.set("Programming cancelled, layout on the device is deactivated")
+				elif ev[0] == "error":
+					self.status.set("Programming error: %s" % str(ev[1]))
+		except queue.Empty:
+			pass
+		if finished:
+			self.status.end_progress()
+			self.program_job = None
+			if self.exiting:
+				self.quit()
+		else:
+			self.master.after(self._poll_interval, self._poll_programming)
+
+	def report_program_all(self, results):
+		failed = [r for r in results if not r.ok]
+		if len(results) == 0:
+			self.status.set("No devices found")
+		elif len(failed) == 0:
+			self.status.set("Programmed %i devices in %.1f s" %
+					(len(results), max(r.elapsed for r in results)))
+		else:
+			self.status.set("Programming failed on %i of %i devices: %s" %
+					(len(failed), len(results),
+					", ".join("%s: %s" % (r.device_id, str(r.error) or type(r.error).__name__)
+						for r in failed)))
 
 	def ask_save(self):
 		ans = askyesnocancel("Layout modified", "Save modified layout?")
@@ -875,9 +1299,16 @@ class MainMenu(Menu):
 		self.filemenu.add_command(label = "Exit", command = lambda: command("exit"))
 		self.set_save_state(False)
 
+		editmenu = Menu(self, tearoff = False)
+		self.add_cascade(label = "Edit", menu = editmenu)
+		editmenu.add_command(label = "Undo", accelerator = "Ctrl+Z", command = lambda: command("undo"))
+		editmenu.add_command(label = "Redo", accelerator = "Ctrl+Y", command = lambda: command("redo"))
+
 		devmenu = Menu(self, tearoff = False)
 		self.add_cascade(label = "Device", menu = devmenu)
 		devmenu.add_command(label = "Program", command = lambda: command("program"))
+		devmenu.add_command(label = "Program all pages", command = lambda: command("program_full"))
+		devmenu.add_command(label = "Program all attached devices", command = lambda: command("program_all"))
 
 		helpmenu = Menu(self, tearoff = False)
 		self.add_cascade(label = "Help", menu = helpmenu)
@@ -956,6 +1387,29 @@ class StatusBar(Frame):
 		self.label = Label(self, bd = 1, relief = SUNKEN, anchor = W)
 		self.label.pack(side = LEFT, fill = BOTH, expand = True)
 		self.last_status = ""
+		self.progress = Progressbar(self, length = 150)
+		self.cancel = Button(self, text = "Cancel", command = self._on_cancel)
+		self._cancel_cb = None
+
+	def _on_cancel(self):
+		self.cancel.config(state = DISABLED)
+		if self._cancel_cb is not None:
+			self._cancel_cb()
+
+	# shows the progress bar and a cancel button which calls on_cancel
+	def start_progress(self, on_cancel):
+		self._cancel_cb = on_cancel
+		self.progress.config(value = 0, maximum = 1)
+		self.cancel.config(state = NORMAL)
+		self.cancel.pack(side = RIGHT)
+		self.progress.pack(side = RIGHT, padx = 2)
+
+	def set_progress(self, done, total):
+		self.progress.config(value = done, maximum = max(total, 1))
+
+	def end_progress(self):
+		self.progress.pack_forget()
+		self.cancel.pack_forget()
 
 	def set(self, status):
 		self.last_status = status
@@ -972,19 +1426,15 @@ class StatusBar(Frame):
 		self.last_status = ""
 
 
-tree = ET.parse("gh60.xml")
-keyboard = tree.getroot()
-w = int(keyboard.attrib['width'])
-h = int(keyboard.attrib['height'])
-num_keys = int(keyboard.attrib['num_keys'])
-buttons = Buttons(num_keys, w, h)
-for key in keyboard:
-	no = int(key.attrib['id'])
-	buttons.add_button(no,
-			int(key.attrib['width']), int(key.attrib['height']),
-			int(key.attrib['x']), int(key.attrib['y']))
-
 root = Tk()
+# show a window before the rest is set up
+root.wm_geometry("800x600+0+0")
+loading = Label(root, text = "Loading...")
+loading.pack(expand = True)
+root.update()
+
+buttons = Buttons.from_xml("gh60.xml")
+loading.destroy()
 
 #app = ScancodeEntry(root, lambda: 0)
 #app.pack()
@@ -992,6 +1442,8 @@ root = Tk()
 
 #exit()
 
-app = MainWindow(root, buttons)
+# keyboards with many keys are drawn on a canvas, which scales better
+use_canvas = "--canvas" in sys.argv[1:] or buttons.num_keys > 100
+app = MainWindow(root, buttons, use_canvas = use_canvas)
 
 root.mainloop()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# Command line interface to ukbdc_lib, for use without a display
+import argparse
+import os
+import sys
+import time
+
+from ukbdc_lib.layout import Layout, INHERITED
+from ukbdc_lib.firmware import BASE_FIRMWARE, LAYOUT_ADDR, read_firmware, write_firmware
+
+def load_layout(fname):
+	with open(fname, "rb") as f:
+		return Layout.from_binary(f.read())
+
+# name of the output file for input fname, with extension ext,
+# in outdir or next to the input
+def output_name(fname, ext, outdir):
+	base = os.path.splitext(os.path.basename(fname))[0] + ext
+	if outdir is None:
+		return os.path.join(os.path.dirname(fname), base)
+	return os.path.join(outdir, base)
+
+def write_file(fname, data, mode = "wb"):
+	with open(fname, mode) as f:
+		f.write(data)
+
+def error(fname, e):
+	print("%s: %s" % (fname, e), file = sys.stderr)
+
+# creates the output directory, if one is given
+def make_output(outdir):
+	if outdir is None:
+		return True
+	try:
+		os.makedirs(outdir, exist_ok = True)
+	except OSError as e:
+		error(outdir, e)
+		return False
+	return True
+
+def cmd_convert(args):
+	if not make_output(args.output):
+		return False
+	ok = True
+	for fname in args.files:
+		try:
+			out = output_name(fname, ".bin", args.output)
+			write_file(out, load_layout(fname).binary(fordevice = True))
+			if args.verbose:
+				print("%s -> %s" % (fname, out))
+		except (OSError, ValueError) as e:
+			error(fname, e)
+			ok = False
+	return ok
+
+def cmd_generate(args):
+	try:
+		firmware = read_firmware(args.firmware)
+	except (OSError, ValueError) as e:
+		error(args.firmware, e)
+		return False
+	if not make_output(args.output):
+		return False
+	ok = True
+	for fname in args.files:
+		try:
+			out = output_name(fname, ".hex", args.output)
+			data = load_layout(fname).binary(fordevice = True)
+			write_firmware(out, firmware, data, args.address)
+			if args.verbose:
+				print("%s -> %s" % (fname, out))
+		except (OSError, ValueError) as e:
+			error(fname, e)
+			ok = False
+	return ok
+
+def cmd_batch(args):
+	from ukbdc_lib.batch import layout_files, generate_all
+	start = time.monotonic()
+	try:
+		files = layout_files(args.source)
+		results = generate_all(files, args.output, args.firmware, args.address, args.jobs)
+	except (OSError, ValueError) as e:
+		error(args.source, e)
+		return False
+	for r in results:
+		if not r.ok:
+			error(r.source, r.error)
+		elif args.verbose:
+			print("%s -> %s" % (r.source, r.output))
+	failed = sum(1 for r in results if not r.ok)
+	print("%i generated, %i failed in %.2f s" %
+			(len(results) - failed, failed, time.monotonic() - start))
+	return failed == 0
+
+def program(args, data, metrics):
+	from ukbdc_lib import UKBDC, USBError
+	from ukbdc_lib.multi import program_all
+	if args.all:
+		results = program_all(data, full = args.full, metrics = metrics)
+		if len(results) == 0:
+			error(args.file, "no devices found")
+			return False
+		for r in results:
+			if r.ok:
+				print("%s: programmed in %.2f s, %i pages skipped" % (r.device_id, r.elapsed, r.skipped))
+			else:
+				error(r.device_id, r.error)
+		return all(r.ok for r in results)
+	u = UKBDC(metrics = metrics)
+	try:
+		u.attach()
+		try:
+			skipped = u.program_layout(data, full = args.full)
+		finally:
+			u.detach()
+	except (USBError, RuntimeError) as e:
+		error(args.file, e)
+		return False
+	print("%s: programmed %i bytes, %i pages skipped" % (args.file, len(data), skipped))
+	return True
+
+def cmd_program(args):
+	# imported here, so that other commands work without pyusb
+	try:
+		import ukbdc_lib.multi
+		from ukbdc_lib import USBError
+	except ImportError as e:
+		error(args.file, e)
+		return False
+	try:
+		data = load_layout(args.file).binary(fordevice = True)
+	except (OSError, ValueError) as e:
+		error(args.file, e)
+		return False
+	metrics = None
+	if args.metrics is not None:
+		from ukbdc_lib.metrics import MetricsRecorder
+		metrics = MetricsRecorder()
+	try:
+		return program(args, data, metrics)
+	finally:
+		if metrics is not None:
+			metrics.dump(args.metrics)
+
+def cmd_inspect(args):
+	ok = True
+	for fname in args.files:
+		try:
+			l = load_layout(fname)
+		except (OSError, ValueError) as e:
+			error(fname, e)
+			ok = False
+			continue
+		print("%s: %i keys, %i layers" % (fname, l.no_keys, l.no_layers))
+		for lay in range(0, l.no_layers):
+			inh = sum(1 for key in range(0, l.no_keys) if l.record(lay, key) == INHERITED)
+			parent = "none" if l.parents[lay] == -1 else str(l.parents[lay])
+			print("  layer %2i: parent %4s, %3i defined, %3i inherited" %
+					(lay, parent, l.no_keys - inh, inh))
+	return ok
+
+def cmd_validate(args):
+	ok = True
+	for fname in args.files:
+		try:
+			# resolving all keys finds keys inheriting from nothing
+			load_layout(fname).binary(fordevice = True)
+			if args.verbose:
+				print("%s: ok" % fname)
+		except (OSError, ValueError) as e:
+			error(fname, e)
+			ok = False
+	return ok
+
+def main(argv = None):
+	ap = argparse.ArgumentParser(description = "ukbdc layout tool")
+	ap.add_argument("-v", "--verbose", action = "store_true")
+	# -v is accepted after the command as well; not given there, it doesn't
+	# override the one before
+	common = argparse.ArgumentParser(add_help = False)
+	common.add_argument("-v", "--verbose", action = "store_true", default = argparse.SUPPRESS)
+	sub = ap.add_subparsers(dest = "command")
+	sub.required = True
+
+	p = sub.add_parser("convert", parents = [common], help = "convert .lay files to device images")
+	p.add_argument("files", nargs = "+")
+	p.add_argument("-o", "--output", help = "output directory")
+	p.set_defaults(func = cmd_convert)
+
+	p = sub.add_parser("generate", parents = [common], help = "generate firmware .hex files with layouts")
+	p.add_argument("files", nargs = "+")
+	p.add_argument("-o", "--output", help = "output directory")
+	p.add_argument("-f", "--firmware", default = BASE_FIRMWARE, help = "base firmware file")
+	p.add_argument("-a", "--address", type = lambda s: int(s, 0), default = LAYOUT_ADDR,
+			help = "layout address in flash (default 0x%X)" % LAYOUT_ADDR)
+	p.set_defaults(func = cmd_generate)
+
+	p = sub.add_parser("batch", parents = [common], help = "generate firmware for a directory or manifest of layouts")
+	p.add_argument("source", help = "directory of .lay files or a file listing them")
+	p.add_argument("-o", "--output", required = True, help = "output directory")
+	p.add_argument("-f", "--firmware", default = BASE_FIRMWARE, help = "base firmware file")
+	p.add_argument("-a", "--address", type = lambda s: int(s, 0), default = LAYOUT_ADDR,
+			help = "layout address in flash (default 0x%X)" % LAYOUT_ADDR)
+	p.add_argument("-j", "--jobs", type = int, help = "worker processes (default: number of CPUs)")
+	p.set_defaults(func = cmd_batch)
+
+	p = sub.add_parser("program", parents = [common], help = "write a layout to the device")
+	p.add_argument("file")
+	p.add_argument("--full", action = "store_true", help = "write all pages")
+	p.add_argument("--all", action = "store_true", help = "program all attached devices")
+	p.add_argument("--metrics", help = "write transfer statistics to this JSON file")
+	p.set_defaults(func = cmd_program)
+
+	p = sub.add_parser("inspect", parents = [common], help = "show layout summary")
+	p.add_argument("files", nargs = "+")
+	p.set_defaults(func = cmd_inspect)
+
+	p = sub.add_parser("validate", parents = [common], help = "check layout files")
+	p.add_argument("files", nargs = "+")
+	p.set_defaults(func = cmd_validate)
+
+	args = ap.parse_args(argv)
+	return 0 if args.func(args) else 1
+
+if __name__ == "__main__":
+	sys.exit(main())
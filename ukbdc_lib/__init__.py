@@ -1,2 +1,8 @@
-from .ukbdc import UKBDC
-from usb.core import USBError
+from .ukbdc import UKBDC, ExecuteTimeout, Cancelled
+
+# pyusb is imported on first use of USBError
+def __getattr__(name):
+	if name == "USBError":
+		from usb.core import USBError
+		return USBError
+	raise AttributeError("module %r has no attribute %r" % (__name__, name))
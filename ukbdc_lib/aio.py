@@ -0,0 +1,83 @@
+import asyncio
+import functools
+from .ukbdc import UKBDC
+
+# asyncio interface to a device. Blocking USB I/O runs in an executor (the
+# loop's default one unless given), so a thread is only taken while a
+# transfer is in progress. Operations on one device are serialized.
+#
+# Every operation accepts a timeout in seconds (defaulting to the timeout
+# given to the constructor), after which asyncio.TimeoutError is raised. It
+# covers the time spent waiting for the operations started before, too.
+# A timed out or cancelled operation still owns the device until the
+# transfer already handed to the executor finishes, so the next operation
+# can't interleave with it. program_layout can be cancelled between messages.
+class AsyncUKBDC(object):
+	def __init__(self, images = None, executor = None, timeout = None, metrics = None):
+		self.ukbdc = UKBDC(images = images, metrics = metrics)
+		self.timeout = timeout
+		self._executor = executor
+		self._lock = asyncio.Lock()
+
+	@staticmethod
+	def _retrieve(fut):
+		if not fut.cancelled():
+			fut.exception()
+
+	# Waits for the device and starts fn on it, returns its future
+	async def _start(self, fn):
+		loop = asyncio.get_running_loop()
+		await self._lock.acquire()
+		try:
+			fut = loop.run_in_executor(self._executor, fn)
+		except:
+			self._lock.release()
+			raise
+		fut.add_done_callback(lambda f: self._lock.release())
+		fut.add_done_callback(self._retrieve)
+		return fut
+
+	async def _call(self, fn):
+		return await asyncio.shield(await self._start(fn))
+
+	async def _run(self, timeout, fn, *args, **kwargs):
+		if timeout is None:
+			timeout = self.timeout
+		return await asyncio.wait_for(self._call(functools.partial(fn, *args, **kwargs)), timeout)
+
+	@staticmethod
+	async def find_all(executor = None):
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(executor, UKBDC.find_all)
+
+	async def attach(self, dev = None, transport = None, timeout = None):
+		await self._run(timeout, self.ukbdc.attach, dev, transport)
+
+	async def detach(self, timeout = None):
+		await self._run(timeout, self.ukbdc.detach)
+
+	async def status(self, timeout = None):
+		return await self._run(timeout, self.ukbdc.status)
+
+	async def send(self, msg, timeout = None):
+		return await self._run(timeout, self.ukbdc.send, msg)
+
+	async def _program_layout(self, data, full, progress):
+		u = self.ukbdc
+		upload = await self._run(None, u.begin_upload, data, full)
+		total = len(upload.changed)
+		if total == 0:
+			return len(upload.pages)
+		if progress is not None:
+			progress(0, total)
+		for i in range(0, total):
+			await self._run(None, u.upload_page, upload, i)
+			if progress is not None:
+				progress(i + 1, total)
+		return await self._run(None, u.finish_upload, upload)
+
+	# Same as UKBDC.program_layout, timeout applies to the whole upload
+	async def program_layout(self, data, full = False, progress = None, timeout = None):
+		if timeout is None:
+			timeout = self.timeout
+		return await asyncio.wait_for(self._program_layout(data, full, progress), timeout)
@@ -0,0 +1,264 @@
+import os
+import struct
+import threading
+from .layout import Layout, KEY_SIZE, as_signed, as_unsigned
+
+# Autosave of a layout being edited. Every session (e.g. an editor window)
+# keeps its own directory under a common root, holding:
+#   lock          - locked while the session runs
+#   autosave.lay  - full layout image (the base)
+#   journal.0/1   - changes made since, appended as they happen
+#   filename      - name of the file the layout is edited from, if any
+# Directories which aren't locked are left by sessions which didn't exit
+# cleanly, and can be recovered.
+# Each journal starts with a generation number and the sha1 of the image it
+# applies to. When the current journal grows past threshold bytes, changes go
+# to the other journal file (the next generation), started from a snapshot of
+# the layout, and the snapshot is written as the new base in the background.
+# If that gets interrupted, the old base and both journals still give the
+# layout: recover() replays, oldest first, every journal which applies to the
+# image built so far.
+LOCK = "lock"
+BASE = "autosave.lay"
+JOURNALS = ("journal.0", "journal.1")
+FILENAME = "filename"
+
+MAGIC = b"UKJ1"
+JOURNAL_HEADER = struct.Struct("<4sI20s")
+KEY_RECORD = struct.Struct("cBB%is" % KEY_SIZE)
+PARENT_RECORD = struct.Struct("cBB")
+
+def _sha1(data):
+	import hashlib
+	return hashlib.sha1(data).digest()
+
+def _write_atomic(fname, data):
+	with open(fname + ".tmp", "wb") as f:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(fname + ".tmp", fname)
+
+# lock files of the session directories held by this process
+_held = {}
+
+# Locks the session directory for this process, returns False if another
+# process holds it. The lock goes away with the process.
+def _hold(directory):
+	f = open(os.path.join(directory, LOCK), "a+b")
+	try:
+		try:
+			import fcntl
+		except ImportError:
+			import msvcrt
+			msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+		else:
+			fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		f.close()
+		return False
+	_held[directory] = f
+	return True
+
+# Applies journal records to the layout, stops at the first record which is
+# incomplete (e.g. cut short by a crash) or can't be applied. Returns the
+# number of records applied.
+def _replay(layout, data):
+	pos = 0
+	applied = 0
+	while pos < len(data):
+		kind = data[pos:pos+1]
+		try:
+			if kind == b"K" and pos + KEY_RECORD.size <= len(data):
+				kind, lay, key, rec = KEY_RECORD.unpack_from(data, pos)
+				layout.set_record(lay, key, rec)
+				pos += KEY_RECORD.size
+			elif kind == b"P" and pos + PARENT_RECORD.size <= len(data):
+				kind, lay, parent = PARENT_RECORD.unpack_from(data, pos)
+				layout.parents[lay] = as_signed(parent)
+				pos += PARENT_RECORD.size
+			else:
+				break
+		except (IndexError, ValueError):
+			break
+		applied += 1
+	return applied
+
+class Autosave(object):
+	def __init__(self, root, threshold = 64 * 1024):
+		self.root = root
+		# directory of this session, created by start()
+		self.directory = None
+		self.threshold = threshold
+		self.layout = None
+		# error which stopped saving or compaction
+		self.error = None
+		self._journal = None
+		self._cur = 0
+		self._gen = 0
+		self._compaction = None
+
+	def _path(self, name):
+		return os.path.join(self.directory, name)
+
+	def _open_journal(self, no, image):
+		f = open(self._path(JOURNALS[no]), "wb")
+		f.write(JOURNAL_HEADER.pack(MAGIC, self._gen, _sha1(image)))
+		f.flush()
+		return f
+
+	# Starts saving layout, which was loaded from (or saved to) filename,
+	# dropping what was autosaved before
+	def start(self, layout, filename = None):
+		self.close()
+		self.error = None
+		if self.directory is None:
+			import tempfile
+			os.makedirs(self.root, exist_ok = True)
+			directory = tempfile.mkdtemp(prefix = "session-", dir = self.root)
+			_hold(directory)
+			self.directory = directory
+		image = layout.binary()
+		_write_atomic(self._path(BASE), image)
+		_write_atomic(self._path(FILENAME), os.fsencode(filename or ""))
+		self._cur = 0
+		self._gen = 0
+		self._journal = self._open_journal(0, image)
+		try:
+			os.remove(self._path(JOURNALS[1]))
+		except FileNotFoundError:
+			pass
+		self.layout = layout
+
+	# A failure stops saving, but not editing: it is kept in error
+	def _append(self, rec):
+		if self._journal is None:
+			return
+		try:
+			self._journal.write(rec)
+			self._journal.flush()
+			if self._journal.tell() > self.threshold:
+				self.compact()
+		except OSError as e:
+			self.error = e
+			self.close()
+
+	# observer interface of history.History
+
+	def key_changed(self, lay, key, rec):
+		self._append(KEY_RECORD.pack(b"K", lay, key, rec))
+
+	def parent_changed(self, lay, parent):
+		self._append(PARENT_RECORD.pack(b"P", lay, as_unsigned(parent)))
+
+	# Switches to the other journal and writes the current layout as the base
+	# in a background thread. Does nothing while the last compaction runs, or
+	# if one failed: the other journal is then still needed to recover.
+	def compact(self):
+		if self._journal is None or self.error is not None:
+			return
+		if self._compaction is not None and self._compaction.is_alive():
+			return
+		image = self.layout.binary()
+		old = self._cur
+		self._cur = 1 - old
+		self._gen += 1
+		self._journal.close()
+		self._journal = self._open_journal(self._cur, image)
+		self._compaction = threading.Thread(target = self._write_base,
+				args = (image, old), daemon = True)
+		self._compaction.start()
+
+	def _write_base(self, image, old_journal):
+		try:
+			_write_atomic(self._path(BASE), image)
+			os.remove(self._path(JOURNALS[old_journal]))
+		except OSError as e:
+			# the old base and journal are still valid
+			self.error = e
+
+	def close(self):
+		if self._compaction is not None:
+			self._compaction.join()
+			self._compaction = None
+		if self._journal is not None:
+			self._journal.close()
+			self._journal = None
+
+	# Stops saving and removes the session directory, e.g. when the editor
+	# exits and its changes are saved or discarded
+	def discard(self):
+		self.close()
+		self.layout = None
+		if self.directory is not None:
+			Autosave.remove(self.directory)
+			self.directory = None
+
+	# Directories of the sessions under root which are not running any more.
+	# They stay locked by this process until remove() or release().
+	@staticmethod
+	def abandoned(root):
+		try:
+			names = sorted(os.listdir(root))
+		except OSError:
+			return []
+		dirs = []
+		for name in names:
+			directory = os.path.join(root, name)
+			if os.path.isdir(directory) and directory not in _held and _hold(directory):
+				dirs.append(directory)
+		return dirs
+
+	# Unlocks a session directory held by this process
+	@staticmethod
+	def release(directory):
+		f = _held.pop(directory, None)
+		if f is not None:
+			f.close()
+
+	# Removes a session directory held by this process
+	@staticmethod
+	def remove(directory):
+		Autosave.release(directory)
+		try:
+			# including temporary files left by an interrupted write
+			for name in os.listdir(directory):
+				os.remove(os.path.join(directory, name))
+			os.rmdir(directory)
+		except OSError:
+			pass
+
+	# Returns (layout, filename) autosaved in a session directory, or None if
+	# there is nothing to recover: no autosave, or one without any changes
+	@staticmethod
+	def recover(directory):
+		try:
+			with open(os.path.join(directory, BASE), "rb") as f:
+				layout = Layout.from_binary(f.read())
+		except (OSError, ValueError):
+			return None
+		try:
+			with open(os.path.join(directory, FILENAME), "rb") as f:
+				filename = os.fsdecode(f.read()) or None
+		except OSError:
+			filename = None
+		journals = []
+		for name in JOURNALS:
+			try:
+				with open(os.path.join(directory, name), "rb") as f:
+					data = f.read()
+			except OSError:
+				continue
+			if len(data) >= JOURNAL_HEADER.size:
+				magic, gen, digest = JOURNAL_HEADER.unpack_from(data)
+				if magic == MAGIC:
+					journals.append((gen, digest, data))
+		# a journal of generation other than 0 means the base was compacted
+		changed = any(gen > 0 for gen, digest, data in journals)
+		for gen, digest, data in sorted(journals):
+			if digest == _sha1(layout.binary()):
+				if _replay(layout, memoryview(data)[JOURNAL_HEADER.size:]) > 0:
+					changed = True
+		if not changed:
+			return None
+		return layout, filename
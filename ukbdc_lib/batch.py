@@ -0,0 +1,77 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+from .layout import Layout
+from .firmware import BASE_FIRMWARE, LAYOUT_ADDR, read_firmware, write_firmware
+
+class GenerateResult(object):
+	def __init__(self, source, output, error = None, elapsed = 0.0):
+		self.source = source
+		self.output = output
+		self.error = error
+		self.elapsed = elapsed
+
+	@property
+	def ok(self):
+		return self.error is None
+
+# Layout files to process: all .lay files in a directory, or the files listed
+# in a manifest, one per line, relative to the manifest (# starts a comment)
+def layout_files(path):
+	if os.path.isdir(path):
+		return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".lay"))
+	files = []
+	with open(path, "r") as f:
+		for line in f:
+			line = line.split("#", 1)[0].strip()
+			if line != "":
+				files.append(os.path.join(os.path.dirname(path), line))
+	return files
+
+# base firmware of the worker process, parsed once by _init_worker
+_firmware = None
+
+def _init_worker(fname):
+	global _firmware
+	_firmware = read_firmware(fname)
+
+def _generate_one(job):
+	source, output, addr = job
+	res = GenerateResult(source, output)
+	start = time.monotonic()
+	try:
+		with open(source, "rb") as f:
+			data = Layout.from_binary(f.read()).binary(fordevice = True)
+		write_firmware(output, _firmware, data, addr)
+	except Exception as e:
+		res.error = e
+	res.elapsed = time.monotonic() - start
+	return res
+
+# Generates a firmware .hex file in outdir for each of the layout files, in
+# worker processes (os.cpu_count() by default). Returns a GenerateResult for
+# every file; errors are reported in the results instead of being raised,
+# except for a bad base firmware, which fails the whole batch.
+def generate_all(files, outdir, firmware = BASE_FIRMWARE, addr = LAYOUT_ADDR, workers = None):
+	read_firmware(firmware)
+	jobs = []
+	outputs = {}
+	for source in files:
+		output = os.path.join(outdir, os.path.splitext(os.path.basename(source))[0] + ".hex")
+		if output in outputs:
+			raise ValueError("%s and %s would both be written to %s" %
+					(outputs[output], source, output))
+		outputs[output] = source
+		jobs.append((source, output, addr))
+	os.makedirs(outdir, exist_ok = True)
+	if workers is None:
+		workers = os.cpu_count() or 1
+	workers = min(workers, len(jobs))
+	if workers <= 1:
+		_init_worker(firmware)
+		return [_generate_one(job) for job in jobs]
+	# several layouts per task, so that workers don't wait for each other
+	chunksize = max(1, len(jobs) // (workers * 8))
+	with ProcessPoolExecutor(max_workers = workers,
+			initializer = _init_worker, initargs = (firmware,)) as pool:
+		return list(pool.map(_generate_one, jobs, chunksize = chunksize))
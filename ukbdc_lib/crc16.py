@@ -37,10 +37,101 @@ crc_lo_byte = [
 	0x44, 0x84, 0x85, 0x45, 0x87, 0x47, 0x46, 0x86, 0x82, 0x42, 0x43, 0x83, 0x41, 0x81, 0x80, 0x40
 ]
 
-def crc16(data):
-	crc_hi, crc_lo = 0xff, 0xff
+import sys
+
+CRC_INIT = 0xffff
+
+# Both tables merged, indexed by the register value xor a 16-bit little-endian
+# word of data: one lookup processes two bytes. Built on first use.
+_word_table = None
+
+def _get_word_table():
+	global _word_table
+	if _word_table is None:
+		t = [(lo << 8) | hi for hi, lo in zip(crc_hi_byte, crc_lo_byte)]
+		step = [(x >> 8) ^ t[x & 0xff] for x in range(0, 0x10000)]
+		_word_table = [(c >> 8) ^ t[c & 0xff] for c in step]
+	return _word_table
+
+# numpy module, False if it is not installed. Imported on first use, as
+# loading it takes longer than most programs need this module for.
+_numpy = None
+
+def _get_numpy():
+	global _numpy
+	if _numpy is None:
+		try:
+			import numpy
+		except ImportError:
+			numpy = False
+		_numpy = numpy
+	return _numpy
+
+def _update_bytes(crc, data):
+	crc_hi, crc_lo = crc >> 8, crc & 0xff
 	for b in data:
 		idx = crc_lo ^ b
 		crc_lo = crc_hi ^ crc_hi_byte[idx]
 		crc_hi = crc_lo_byte[idx]
 	return (crc_hi << 8) + crc_lo
+
+def _update(crc, data):
+	if len(data) < 64 or sys.byteorder != "little":
+		return _update_bytes(crc, data)
+	table = _get_word_table()
+	data = memoryview(data).cast('B')
+	n = len(data) & ~1
+	for w in data[:n].cast('H'):
+		crc = table[crc ^ w]
+	return _update_bytes(crc, data[n:])
+
+def crc16(data):
+	if not isinstance(data, (bytes, bytearray, memoryview)):
+		data = bytes(data)
+	return _update(CRC_INIT, data)
+
+# Incremental computation, crc16(a + b) == CRC16().update(a).update(b).digest()
+class CRC16(object):
+	def __init__(self, data = b''):
+		self._crc = CRC_INIT
+		self.update(data)
+
+	def update(self, data):
+		if not isinstance(data, (bytes, bytearray, memoryview)):
+			data = bytes(data)
+		self._crc = _update(self._crc, data)
+		return self
+
+	def digest(self):
+		return self._crc
+
+	def copy(self):
+		c = CRC16()
+		c._crc = self._crc
+		return c
+
+# Checksums of many buffers. With numpy available, buffers of equal length
+# are processed together, one byte position of all of them at a time.
+def crc16_many(buffers):
+	buffers = [bytes(b) for b in buffers]
+	numpy = _get_numpy() if len(buffers) >= 16 else None
+	if not numpy:
+		return [crc16(b) for b in buffers]
+	hi = numpy.array(crc_hi_byte, dtype = numpy.uint8)
+	lo = numpy.array(crc_lo_byte, dtype = numpy.uint8)
+	res = [0] * len(buffers)
+	by_len = {}
+	for i, b in enumerate(buffers):
+		by_len.setdefault(len(b), []).append(i)
+	for length, idx in by_len.items():
+		data = numpy.frombuffer(b''.join(buffers[i] for i in idx), dtype = numpy.uint8)
+		data = data.reshape(len(idx), length)
+		crc_hi = numpy.full(len(idx), 0xff, dtype = numpy.uint8)
+		crc_lo = numpy.full(len(idx), 0xff, dtype = numpy.uint8)
+		for pos in range(0, length):
+			i = crc_lo ^ data[:, pos]
+			crc_lo = crc_hi ^ hi[i]
+			crc_hi = lo[i]
+		for i, h, l in zip(idx, crc_hi.tolist(), crc_lo.tolist()):
+			res[i] = (h << 8) + l
+	return res
@@ -0,0 +1,146 @@
+import time
+from .crc16 import crc16
+from .layout import PAGE_SIZE
+from .ukbdc import Status
+
+# Software model of the ukbdc firmware message protocol, for testing and
+# benchmarking without hardware. A message starts with a Start packet
+# (length, crc16, beginning of the message), continues with Cont packets and
+# is executed once complete; the device reports EXECUTING for
+# execute_latency seconds (per message type, see latency) afterwards.
+# Errors are reported until the next Start or Reset packet.
+class SimulatedDevice(object):
+	PING  = 0x00
+	START = 0x02
+	CONT  = 0x03
+	RESET = 0x04
+
+	DFU        = 0x00
+	WRITE_PAGE = 0x01
+	ACTIVATE   = 0x02
+	DEACTIVATE = 0x03
+
+	def __init__(self, packet_size = 64, latency = None, no_pages = 64):
+		self.packet_size = packet_size
+		# message type -> execution time in seconds
+		self.latency = {self.WRITE_PAGE: 0.0}
+		if latency is not None:
+			self.latency.update(latency)
+		self.no_pages = no_pages
+		self.pages = {}
+		self.active = True
+		self.dfu = False
+		# counters of received packets by header, for inspection
+		self.packets = {}
+		self.reset()
+
+	def reset(self):
+		self.state = Status.IDLE
+		self._msg = None
+		self._busy_until = 0
+
+	@property
+	def status(self):
+		if self.state == Status.EXECUTING and time.monotonic() >= self._busy_until:
+			self.state = Status.IDLE
+		return self.state
+
+	# the flash contents as one image, unwritten pages are zeros
+	def image(self, size):
+		img = b''.join(self.pages.get(no, bytes(PAGE_SIZE))
+				for no in range(0, (size + PAGE_SIZE - 1) // PAGE_SIZE))
+		return img[:size]
+
+	# Handles a packet sent by the host, returns the response packet (if any)
+	def receive(self, packet):
+		if len(packet) == 0 or len(packet) > self.packet_size:
+			self.state = Status.MESSAGE_ERROR
+			return None
+		hdr, payload = packet[0], bytes(packet[1:])
+		self.packets[hdr] = self.packets.get(hdr, 0) + 1
+		if hdr == self.PING:
+			return bytes([self.PING, self.status])
+		elif hdr == self.RESET:
+			self.reset()
+		elif hdr == self.START:
+			self._start(payload)
+		elif hdr == self.CONT:
+			self._cont(payload)
+		else:
+			self.state = Status.WRONG_MESSAGE_ERROR
+		return None
+
+	def _start(self, payload):
+		if self.status in (Status.EXECUTING, Status.RECEIVING_MESSAGE):
+			self.state = Status.BUSY_ERROR
+			return
+		if len(payload) < 3:
+			self.state = Status.MESSAGE_ERROR
+			return
+		self._len = payload[0]
+		self._crc = payload[1] + (payload[2] << 8)
+		self._msg = bytearray(payload[3:3 + self._len])
+		self.state = Status.RECEIVING_MESSAGE
+		self._check_complete()
+
+	def _cont(self, payload):
+		if self.status != Status.RECEIVING_MESSAGE:
+			self.state = Status.UNEXPECTED_CONT_ERROR
+			return
+		self._msg += payload[:self._len - len(self._msg)]
+		self._check_complete()
+
+	def _check_complete(self):
+		if len(self._msg) < self._len:
+			return
+		msg, self._msg = bytes(self._msg), None
+		if crc16(msg) != self._crc:
+			self.state = Status.CRC_ERROR
+			return
+		if len(msg) == 0:
+			self.state = Status.MESSAGE_ERROR
+			return
+		self.state = self._execute(msg[0], msg[1:])
+		if self.state == Status.EXECUTING:
+			self._busy_until = time.monotonic() + self.latency.get(msg[0], 0.0)
+
+	def _execute(self, kind, payload):
+		if kind == self.WRITE_PAGE:
+			if len(payload) != 1 + PAGE_SIZE or payload[0] >= self.no_pages:
+				return Status.MESSAGE_ERROR
+			self.pages[payload[0]] = payload[1:]
+		elif kind == self.ACTIVATE:
+			self.active = True
+		elif kind == self.DEACTIVATE:
+			self.active = False
+		elif kind == self.DFU:
+			self.dfu = True
+		else:
+			return Status.WRONG_MESSAGE_ERROR
+		return Status.EXECUTING
+
+# Transport (see transport.py) connecting UKBDC to a SimulatedDevice
+class SimulatedTransport(object):
+	def __init__(self, device = None, device_id = "simulated"):
+		if device is None:
+			device = SimulatedDevice()
+		self.device = device
+		self.device_id = device_id
+		self._responses = []
+
+	@property
+	def packet_size(self):
+		return self.device.packet_size
+
+	def write(self, data, timeout):
+		resp = self.device.receive(data)
+		if resp is not None:
+			self._responses.append(resp)
+
+	def read(self, timeout):
+		if len(self._responses) == 0:
+			raise IOError("read timed out")
+		return self._responses.pop(0)
+
+	def close(self):
+		pass
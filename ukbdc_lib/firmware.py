@@ -0,0 +1,33 @@
+import os
+from . import ihex
+
+BASE_FIRMWARE = "base_firmware.hex"
+# where the layout is placed in flash
+LAYOUT_ADDR = 0x2700
+
+# Parsed base firmware (an ihex.HexImage), cached until the file changes
+def read_firmware(fname = BASE_FIRMWARE):
+	return ihex.load(fname)
+
+def firmware_sha1(firmware):
+	return firmware.sha1
+
+# Places the layout image in the firmware at addr, returns the resulting image.
+# Raises ValueError if the layout would overwrite part of the firmware.
+def generate_firmware(firmware, data, addr = LAYOUT_ADDR):
+	return firmware.patched(addr, data)
+
+# Writes the firmware with the layout image as a HEX file. The file is
+# replaced only once it is complete.
+def write_firmware(fname, firmware, data, addr = LAYOUT_ADDR):
+	image = generate_firmware(firmware, data, addr)
+	try:
+		with open(fname + ".tmp", "w") as f:
+			image.write(f)
+		os.replace(fname + ".tmp", fname)
+	except BaseException:
+		try:
+			os.remove(fname + ".tmp")
+		except OSError:
+			pass
+		raise
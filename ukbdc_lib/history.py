@@ -0,0 +1,147 @@
+from collections import deque
+from contextlib import contextmanager
+import struct
+
+# one key change: layer, key, old record, new record
+KEY_CHANGE = struct.Struct('BB4s4s')
+# approximate memory taken by a parent change and by an edit besides its changes
+PARENT_CHANGE_SIZE = 64
+EDIT_SIZE = 200
+
+# A group of changes undone and redone together
+class Edit(object):
+	__slots__ = ('label', 'keys', 'parents')
+
+	def __init__(self, label):
+		self.label = label
+		# packed KEY_CHANGE records
+		self.keys = bytearray()
+		# (layer, old parent, new parent)
+		self.parents = []
+
+	@property
+	def size(self):
+		return EDIT_SIZE + len(self.keys) + PARENT_CHANGE_SIZE * len(self.parents)
+
+	# numbers of the keys changed, on any layer
+	@property
+	def key_nos(self):
+		return set(no for lay, no, old, new in KEY_CHANGE.iter_unpack(self.keys))
+
+# Undo/redo history of a Layout. Changes are made through it and recorded as
+# deltas: old and new records of keys and old and new parents of layers.
+# Changes made inside group() are undone in one step. The oldest edits are
+# dropped when the history takes more than max_size bytes.
+# If observer is set, its key_changed(lay, key, rec) and
+# parent_changed(lay, parent) are called for every change made to the layout,
+# including undo and redo.
+class History(object):
+	def __init__(self, layout, max_size = 1 << 20, observer = None):
+		self.layout = layout
+		self.max_size = max_size
+		self.observer = observer
+		self.size = 0
+		self._undo = deque()
+		self._redo = []
+		self._group = None
+		self._depth = 0
+
+	@property
+	def can_undo(self):
+		return len(self._undo) > 0
+
+	@property
+	def can_redo(self):
+		return len(self._redo) > 0
+
+	def clear(self):
+		self._undo.clear()
+		self._redo = []
+		self.size = 0
+
+	# Changes made in the block form one edit (nested groups are merged
+	# into the outermost one)
+	@contextmanager
+	def group(self, label = None):
+		if self._depth == 0:
+			self._group = Edit(label)
+		self._depth += 1
+		try:
+			yield
+		finally:
+			self._depth -= 1
+			if self._depth == 0:
+				edit, self._group = self._group, None
+				self._push(edit)
+
+	def _push(self, edit):
+		if len(edit.keys) == 0 and len(edit.parents) == 0:
+			return
+		self._redo = []
+		self._undo.append(edit)
+		self.size += edit.size
+		# keep at least the edit just made
+		while self.size > self.max_size and len(self._undo) > 1:
+			self.size -= self._undo.popleft().size
+
+	def _set_record(self, lay, key, rec):
+		self.layout.set_record(lay, key, rec)
+		if self.observer is not None:
+			self.observer.key_changed(lay, key, rec)
+
+	def _set_parent(self, lay, parent):
+		self.layout.parents[lay] = parent
+		if self.observer is not None:
+			self.observer.parent_changed(lay, parent)
+
+	def set_record(self, lay, key, rec):
+		rec = bytes(rec)
+		old = self.layout.record(lay, key)
+		if old == rec:
+			return
+		self._set_record(lay, key, rec)
+		with self.group():
+			self._group.keys += KEY_CHANGE.pack(lay, key, old, rec)
+
+	def __setitem__(self, pos, kd):
+		lay, key = pos
+		self.set_record(lay, key, kd.record)
+
+	def set_parent(self, lay, parent):
+		old = self.layout.parents[lay]
+		if old == parent:
+			return
+		self._set_parent(lay, parent)
+		with self.group():
+			self._group.parents.append((lay, old, parent))
+
+	def _apply(self, edit, undo):
+		keys = list(KEY_CHANGE.iter_unpack(edit.keys))
+		parents = edit.parents
+		if undo:
+			keys.reverse()
+			parents = list(reversed(parents))
+		for lay, key, old, new in keys:
+			self._set_record(lay, key, old if undo else new)
+		for lay, old, new in parents:
+			self._set_parent(lay, old if undo else new)
+
+	# Reverts the last edit and returns it, or None if there is none
+	def undo(self):
+		if not self._undo:
+			return None
+		edit = self._undo.pop()
+		self.size -= edit.size
+		self._apply(edit, undo = True)
+		self._redo.append(edit)
+		return edit
+
+	# Repeats the last undone edit and returns it, or None if there is none
+	def redo(self):
+		if not self._redo:
+			return None
+		edit = self._redo.pop()
+		self._apply(edit, undo = False)
+		self._undo.append(edit)
+		self.size += edit.size
+		return edit
@@ -0,0 +1,183 @@
+import os
+
+# record types
+DATA		= 0x00
+EOF		= 0x01
+EXT_SEGMENT	= 0x02
+START_SEGMENT	= 0x03
+EXT_LINEAR	= 0x04
+START_LINEAR	= 0x05
+
+# data bytes per emitted record
+RECORD_LEN = 16
+
+EOF_RECORD = ":00000001FF\n"
+
+def _record(typ, addr, data):
+	rec = bytes([len(data), (addr >> 8) & 0xff, addr & 0xff, typ]) + bytes(data)
+	return ":%s%.2X\n" % (rec.hex().upper(), -sum(rec) & 0xff)
+
+# numpy module, False if it is not installed. Imported on first use, as
+# the programs loading this module mostly start faster without it.
+_numpy = None
+
+def _get_numpy():
+	global _numpy
+	if _numpy is None:
+		try:
+			import numpy
+		except ImportError:
+			numpy = False
+		_numpy = numpy
+	return _numpy
+
+# Sums of the data of each RECORD_LEN bytes long record of data
+def _record_sums(data):
+	n = len(data) // RECORD_LEN * RECORD_LEN
+	numpy = _get_numpy() if n >= 64 * RECORD_LEN else None
+	if not numpy:
+		return [sum(data[i:i+RECORD_LEN]) for i in range(0, len(data), RECORD_LEN)]
+	full = numpy.frombuffer(data, dtype = numpy.uint8, count = n)
+	sums = full.reshape(-1, RECORD_LEN).sum(axis = 1, dtype = numpy.uint32).tolist()
+	if n < len(data):
+		sums.append(sum(data[n:]))
+	return sums
+
+# Data records of data placed at 16-bit address addr
+def _data_records(addr, data):
+	lines = []
+	for i, s in zip(range(0, len(data), RECORD_LEN), _record_sums(data)):
+		chunk = data[i:i+RECORD_LEN]
+		a = addr + i
+		chksum = -(len(chunk) + (a >> 8) + (a & 0xff) + s) & 0xff
+		lines.append(":%.2X%.4X00%s%.2X\n" % (len(chunk), a, chunk.hex().upper(), chksum))
+	return lines
+
+# Contents of an Intel HEX file as a sparse memory image: a sorted list of
+# (address, data) segments which neither overlap nor touch each other.
+# Images are not modified once built, patched() returns a new image.
+class HexImage(object):
+	def __init__(self, segments = (), start = ()):
+		self.segments = list(segments)
+		# start address records as (type, data), written before EOF
+		self.start = list(start)
+		# sha1 of the file the image was loaded from
+		self.sha1 = None
+
+	@classmethod
+	def parse(cls, lines):
+		runs = []
+		start = []
+		base = 0
+		run_addr, run = None, None
+		for no, line in enumerate(lines, 1):
+			line = line.strip()
+			if line == "":
+				continue
+			try:
+				if line[0] != ":":
+					raise ValueError("missing start code")
+				rec = bytes.fromhex(line[1:])
+			except ValueError as e:
+				raise ValueError("line %i: %s" % (no, e))
+			if len(rec) < 5 or len(rec) != rec[0] + 5:
+				raise ValueError("line %i: wrong record length" % no)
+			if sum(rec) & 0xff != 0:
+				raise ValueError("line %i: wrong checksum" % no)
+			typ, data = rec[3], rec[4:-1]
+			if typ == DATA:
+				addr = base + ((rec[1] << 8) | rec[2])
+				if run is not None and addr == run_addr + len(run):
+					run += data
+				else:
+					run_addr, run = addr, bytearray(data)
+					runs.append((run_addr, run))
+			elif typ == EOF:
+				break
+			elif typ == EXT_SEGMENT and len(data) == 2:
+				base = ((data[0] << 8) | data[1]) << 4
+			elif typ == EXT_LINEAR and len(data) == 2:
+				base = ((data[0] << 8) | data[1]) << 16
+			elif typ in (START_SEGMENT, START_LINEAR) and len(data) == 4:
+				start.append((typ, bytes(data)))
+			else:
+				raise ValueError("line %i: bad record of type %.2X" % (no, typ))
+		else:
+			raise ValueError("no EOF record")
+		runs.sort(key = lambda r: r[0])
+		segments = []
+		for addr, data in runs:
+			if segments:
+				prev_addr, prev = segments[-1]
+				if addr < prev_addr + len(prev):
+					raise ValueError("data at 0x%X defined twice" % addr)
+				if addr == prev_addr + len(prev):
+					prev += data
+					continue
+			segments.append((addr, data))
+		return cls([(addr, bytes(data)) for addr, data in segments], start)
+
+	def overlaps(self, addr, size):
+		return any(a < addr + size and addr < a + len(d) for a, d in self.segments)
+
+	# A copy of the image with data placed at addr. Raises ValueError
+	# if it would overwrite anything in the image.
+	def patched(self, addr, data):
+		if addr < 0 or addr + len(data) > 0x100000000:
+			raise ValueError("address 0x%X out of range" % addr)
+		if self.overlaps(addr, len(data)):
+			raise ValueError("%i bytes at 0x%X overlap the image" % (len(data), addr))
+		segments = sorted(self.segments + [(addr, bytes(data))], key = lambda s: s[0])
+		image = HexImage(segments, self.start)
+		image.sha1 = self.sha1
+		return image
+
+	# HEX file lines, generated one segment at a time
+	def records(self):
+		upper = 0
+		for addr, data in self.segments:
+			pos = 0
+			while pos < len(data):
+				a = addr + pos
+				if a >> 16 != upper:
+					upper = a >> 16
+					yield _record(EXT_LINEAR, 0, bytes([upper >> 8, upper & 0xff]))
+				# a record may not cross a 64K boundary
+				n = min(len(data) - pos, 0x10000 - (a & 0xffff))
+				for line in _data_records(a & 0xffff, memoryview(data)[pos:pos+n]):
+					yield line
+				pos += n
+		for typ, data in self.start:
+			yield _record(typ, 0, data)
+		yield EOF_RECORD
+
+	def write(self, f):
+		f.writelines(self.records())
+
+# path -> ((mtime, size), sha1, image)
+_cache = {}
+
+# Parses a HEX file. The image is kept until the file changes: when its
+# mtime changes, it is parsed again only if its contents changed as well.
+def load(fname):
+	import hashlib
+	path = os.path.abspath(fname)
+	st = os.stat(path)
+	stamp = (st.st_mtime_ns, st.st_size)
+	cached = _cache.get(path)
+	if cached is not None and cached[0] == stamp:
+		return cached[2]
+	with open(path, "rb") as f:
+		raw = f.read()
+	sha1 = hashlib.sha1(raw).hexdigest()
+	if cached is not None and cached[1] == sha1:
+		image = cached[2]
+	else:
+		try:
+			text = raw.decode("ascii")
+		except UnicodeDecodeError:
+			raise ValueError("not a HEX file")
+		image = HexImage.parse(text.splitlines())
+		image.sha1 = sha1
+	_cache[path] = (stamp, sha1, image)
+	return image
@@ -1,4 +1,4 @@
-from ctypes import c_uint8
+import struct
 from .mnemonics import mnemonics, scancodes
 
 def as_signed(x):
@@ -13,6 +13,17 @@ def as_unsigned(x):
 	else:
 		return x
 
+# size of a single key definition in the binary format
+KEY_SIZE = 4
+# key definition record meaning "inherited from parent layer"
+INHERITED = b'\xff\xff\xff\xff'
+# the same record seen as a 32-bit word
+INHERITED_WORD = 0xffffffff
+# number of keys, number of layers
+HEADER = struct.Struct('BB')
+# size of a flash page the device image is written in
+PAGE_SIZE = 128
+
 class Action(object):
 	Abs   = 0x02
 	Rel   = 0x01
@@ -29,30 +40,65 @@ class Abs(Action):
 	def __init__(self, layer):
 		super(Abs, self).__init__(Action.Abs, layer)
 
+def encode_keydef(scancode, press, release):
+	return bytes([
+		scancode & 0xff,
+		((press.kind << 4) + release.kind) & 0xff,
+		press.arg & 0xff,
+		release.arg & 0xff
+	])
+
+# A key definition is either a standalone record (when created by the user),
+# or a view on the packed storage of a Layout (when obtained from layout[lay, key])
 class KeyDef(object):
+	__slots__ = ('_lay', '_layer', '_no', '_rec')
+
 	def __init__(self, layout = None, layer = None, no = None, scancode = 0, press = None, release = None, inherited = False):
 		self._lay = layout
 		self._layer = layer
 		self._no = no
-		self._inherited = inherited
-		if type(scancode) is int:
-			self._scancode = scancode
-		else:
-			self._scancode = scancodes[scancode]
-		if press is not None:
-			self._press = press
-		else:
-			self._press = Action(0x00)
-		if release is not None:
-			self._release = release
+		if inherited:
+			self._rec = INHERITED
+			return
+		if type(scancode) is not int:
+			scancode = scancodes[scancode]
+		if press is None:
+			press = Action(0x00)
+		if release is None:
+			release = Action(0x00)
+		self._rec = encode_keydef(scancode, press, release)
+
+	@classmethod
+	def view(cls, layout, layer, no):
+		kd = cls.__new__(cls)
+		kd._lay = layout
+		kd._layer = layer
+		kd._no = no
+		kd._rec = None
+		return kd
+
+	# raw 4-byte record of this key definition (not resolved)
+	@property
+	def record(self):
+		if self._rec is None:
+			return self._lay.record(self._layer, self._no)
 		else:
-			self._release = Action(0x00)
+			return self._rec
 
 	def get_root(self):
-		if self.inherited:
+		if not self.inherited:
+			return self
+		elif self._rec is None:
+			return self._lay.get_root(self._layer, self._no)
+		else:
 			return self._lay.get_parent(self).get_root()
+
+	# record of the definition this key resolves to
+	def _root_record(self):
+		if self._rec is None:
+			return self._lay.root_record(self._layer, self._no)
 		else:
-			return self
+			return self.get_root().record
 
 	@property
 	def no(self):
@@ -64,31 +110,43 @@ class KeyDef(object):
 
 	@property
 	def scancode(self):
-		return self.get_root()._scancode
+		return self._root_record()[0]
 
 	@property
 	def press(self):
-		return self.get_root()._press
+		rec = self._root_record()
+		return Action(rec[1] >> 4, as_signed(rec[2]))
 
 	@property
 	def release(self):
-		return self.get_root()._release
+		rec = self._root_record()
+		return Action(rec[1] & 0x0f, as_signed(rec[3]))
 
 	@property
 	def inherited(self):
-		return self._inherited
+		return self.record == INHERITED
 
 	@inherited.setter
 	def inherited(self, val):
-		self._inherited = val
+		if val == self.inherited:
+			return
+		if val:
+			rec = INHERITED
+		elif self._lay is not None:
+			# keep the definition which was visible through inheritance
+			rec = self._root_record()
+		else:
+			rec = encode_keydef(0, Action(0x00), Action(0x00))
+		if self._rec is None:
+			self._lay.set_record(self._layer, self._no, rec)
+		else:
+			self._rec = rec
 
 	def binary(self, fordevice):
 		if self.inherited and not fordevice:
-			return b'\xff\xff\xff\xff'
+			return INHERITED
 		else:
-			actions = (self.press.kind << 4) + self.release.kind
-			fields = [self.scancode, actions, self.press.arg, self.release.arg]
-			return b''.join(map(lambda x: bytes(c_uint8(x)), fields))
+			return self._root_record()
 
 	@property
 	def nicename(self):
@@ -100,33 +158,185 @@ class KeyDef(object):
 			else:
 				return hex(self.scancode)
 
+# Raises ValueError unless every layer inherits from an existing layer
+# (or from none) and there are no cycles
+def check_parents(parents):
+	for lay, p in enumerate(parents):
+		if p != -1 and not 0 <= p < len(parents):
+			raise ValueError("layer %i has invalid parent %i" % (lay, p))
+	for lay in range(0, len(parents)):
+		l = lay
+		for i in range(0, len(parents)):
+			l = parents[l]
+			if l == -1:
+				break
+		else:
+			raise ValueError("layer %i inherits from itself" % lay)
+
+# List of layer parents which notifies the layout about modifications.
+# It can only be changed by assigning items or slices of the same length:
+# the number of layers is fixed.
+class Parents(list):
+	def __init__(self, layout, parents):
+		super(Parents, self).__init__(parents)
+		self._lay = layout
+
+	def _unsupported(self, *args, **kwargs):
+		raise TypeError("parents can only be changed by assigning to items")
+
+	append = extend = insert = pop = remove = clear = _unsupported
+	sort = reverse = __delitem__ = __iadd__ = __imul__ = _unsupported
+
+	def __setitem__(self, idx, val):
+		new = list(self)
+		new[idx] = val
+		if len(new) != len(self):
+			raise ValueError("parents of %i layers needed, got %i" % (len(self), len(new)))
+		check_parents(new)
+		super(Parents, self).__setitem__(idx, val)
+		if isinstance(idx, slice):
+			self._lay._parents_changed(range(0, len(self)))
+		else:
+			self._lay._parents_changed([idx % len(self)])
+
+# Layout keeps all key definitions in one buffer, in the on-disk format:
+# KEY_SIZE bytes per key, layers stored one after another.
+# For every key, the layer its definition is inherited from is kept in
+# a table (-1 if it inherits from nothing), which is updated only for the keys
+# affected by changes of parents or of inherited state.
+# The device image (with inheritance resolved) is cached as well. Changes mark
+# the affected key records stale, and binary(fordevice = True) re-encodes only
+# those. Pages of the image which changed since the last snapshot() are
+# reported by dirty_pages.
 class Layout(object):
 	def __init__(self, no_keys = None, no_layers = None):
 		if no_keys is None or no_layers is None:
 			return
 		self.no_keys = no_keys
 		self.no_layers = no_layers
-		self.layers = []
-		for i in range(0, no_layers):
-			deflay = []
-			for j in range(0, no_keys):
-				deflay.append(KeyDef(layout = self, layer = i, no = j))
-			self.layers.append(deflay)
+		self._data = bytearray(KEY_SIZE * no_keys * no_layers)
 		self.parents = [-1] + [0] * (self.no_layers - 1)
 
+	@property
+	def parents(self):
+		return self._parents
+
+	@parents.setter
+	def parents(self, val):
+		check_parents(val)
+		self._parents = Parents(self, val)
+		self._roots = [-1] * (self.no_keys * self.no_layers)
+		self._update_roots(range(0, self.no_layers), range(0, self.no_keys))
+		# whole image has to be rebuilt
+		self._image = None
+		self._stale = set()
+		self._dirty = set(range(0, self._no_pages))
+		self._snap = None
+
+	# Recomputes roots of given keys on given layers. Roots of the keys on
+	# all other layers must be up to date.
+	def _update_roots(self, layers, keys):
+		nk = self.no_keys
+		keys = list(keys)
+		full = keys == list(range(0, nk))
+		layers = set(layers)
+		# only the rows of the keys needed are read
+		words = memoryview(self._data).cast('I')
+		rows = {}
+		def row(lay):
+			if lay == -1:
+				return [-1] * len(keys)
+			elif lay not in layers:
+				return [self._roots[lay * nk + k] for k in keys]
+			elif lay not in rows:
+				base = lay * nk
+				if full:
+					ws = words[base:base + nk].tolist()
+				else:
+					ws = [words[base + k] for k in keys]
+				inh = ws.count(INHERITED_WORD)
+				if inh == 0:
+					rows[lay] = [lay] * len(keys)
+				elif inh == len(keys):
+					rows[lay] = row(self._parents[lay])
+				else:
+					rows[lay] = [lay if w != INHERITED_WORD else pr
+							for w, pr in zip(ws, row(self._parents[lay]))]
+			return rows[lay]
+		try:
+			for lay in layers:
+				if full:
+					self._roots[lay * nk:(lay + 1) * nk] = row(lay)
+				else:
+					for k, root in zip(keys, row(lay)):
+						self._roots[lay * nk + k] = root
+		finally:
+			# the buffer can't be resized while exported
+			words.release()
+
+	# layers whose keys may inherit through one of given layers
+	def _descendants(self, layers):
+		layers = set(layers)
+		desc = []
+		for lay in range(0, self.no_layers):
+			l = lay
+			while l != -1:
+				if l in layers:
+					desc.append(lay)
+					break
+				l = self._parents[l]
+		return desc
+
+	def _parents_changed(self, layers):
+		desc = self._descendants(layers)
+		self._update_roots(desc, range(0, self.no_keys))
+		for lay in desc:
+			self._stale.update(range(lay * self.no_keys, (lay + 1) * self.no_keys))
+
+	def _offset(self, lay, key):
+		if not 0 <= lay < self.no_layers or not 0 <= key < self.no_keys:
+			raise IndexError("no such key: %r" % ((lay, key),))
+		return KEY_SIZE * (lay * self.no_keys + key)
+
 	def __getitem__(self, pos):
 		lay, key = pos
-		return self.layers[lay][key]
+		self._offset(lay, key)
+		return KeyDef.view(self, lay, key)
 
 	def __setitem__(self, pos, val):
 		lay, key = pos
-		kd = self.layers[lay][key]
-		# Do not change reference, because inherited keys are using itk
-		# Copy properties one by one instead
-		kd._inherited = val._inherited
-		kd._scancode = val._scancode
-		kd._press = val._press
-		kd._release = val._release
+		# Copy the record, inherited keys are resolved on access
+		self.set_record(lay, key, val.record)
+
+	def record(self, lay, key):
+		off = self._offset(lay, key)
+		return bytes(self._data[off:off+KEY_SIZE])
+
+	def set_record(self, lay, key, rec):
+		off = self._offset(lay, key)
+		if len(rec) != KEY_SIZE:
+			raise ValueError("key record of %i bytes needed, got %i" % (KEY_SIZE, len(rec)))
+		was_inherited = self._data[off:off+KEY_SIZE] == INHERITED
+		self._data[off:off+KEY_SIZE] = rec
+		desc = self._descendants([lay])
+		if was_inherited != (rec == INHERITED):
+			self._update_roots(desc, [key])
+		self._stale.update(l * self.no_keys + key for l in desc)
+
+	def _root(self, lay, key):
+		root = self._roots[lay * self.no_keys + key]
+		if root == -1:
+			raise ValueError("key %i on layer %i does not inherit from any definition" % (key, lay))
+		return root
+
+	def get_root(self, lay, key):
+		self._offset(lay, key)
+		return KeyDef.view(self, self._root(lay, key), key)
+
+	def root_record(self, lay, key):
+		self._offset(lay, key)
+		off = KEY_SIZE * (self._root(lay, key) * self.no_keys + key)
+		return bytes(self._data[off:off+KEY_SIZE])
 
 	def get_parent(self, key):
 		if self.parents[key.layer] == -1:
@@ -134,34 +344,85 @@ class Layout(object):
 		else:
 			return self[self.parents[key.layer], key.no]
 
+	@property
+	def _no_pages(self):
+		size = HEADER.size + len(self._data)
+		return (size + PAGE_SIZE - 1) // PAGE_SIZE
+
+	def _build_image(self):
+		img = bytearray(HEADER.pack(self.no_keys, self.no_layers)) + self._data
+		for i, root in enumerate(self._roots):
+			lay, key = divmod(i, self.no_keys)
+			if root != lay:
+				root = self._root(lay, key)
+				off = HEADER.size + KEY_SIZE * i
+				roff = KEY_SIZE * (root * self.no_keys + key)
+				img[off:off+KEY_SIZE] = self._data[roff:roff+KEY_SIZE]
+		self._image = img
+
+	# re-encodes stale records of the device image, marking changed pages dirty
+	def _flush_image(self):
+		if self._image is None:
+			self._build_image()
+			self._stale = set()
+			return
+		for i in list(self._stale):
+			lay, key = divmod(i, self.no_keys)
+			roff = KEY_SIZE * (self._root(lay, key) * self.no_keys + key)
+			rec = self._data[roff:roff+KEY_SIZE]
+			off = HEADER.size + KEY_SIZE * i
+			if self._image[off:off+KEY_SIZE] != rec:
+				self._image[off:off+KEY_SIZE] = rec
+				self._dirty.update(range(off // PAGE_SIZE, (off + KEY_SIZE - 1) // PAGE_SIZE + 1))
+			self._stale.discard(i)
+
+	# numbers of device image pages changed since the last snapshot
+	@property
+	def dirty_pages(self):
+		self._flush_image()
+		if self._snap is not None:
+			# drop pages which were modified and then changed back
+			img, snap = self._image, self._snap
+			self._dirty = set(filter(lambda p:
+					img[p*PAGE_SIZE:(p+1)*PAGE_SIZE] != snap[p*PAGE_SIZE:(p+1)*PAGE_SIZE],
+					self._dirty))
+		return sorted(self._dirty)
+
+	# returns the device image and marks all of its pages clean
+	def snapshot(self):
+		self._snap = self.binary(fordevice = True)
+		self._dirty = set()
+		return self._snap
+
 	def binary(self, fordevice = False):
-		hdr = bytes(c_uint8(self.no_keys)) + bytes(c_uint8(self.no_layers))
-		l = b''.join(map(lambda x: b''.join(map(lambda x: x.binary(fordevice), x)), self.layers))
 		if fordevice:
-			return hdr + l
-		else:
-			return hdr + l + bytes(map(as_unsigned, self.parents))
+			self._flush_image()
+			return bytes(self._image)
+		hdr = HEADER.pack(self.no_keys, self.no_layers)
+		return hdr + self._data + bytes(map(as_unsigned, self.parents))
 
 	@staticmethod
 	def from_binary(data):
+		data = memoryview(data)
+		if len(data) < HEADER.size:
+			raise ValueError("layout file truncated: no header")
+		no_keys, no_layers = HEADER.unpack_from(data)
+		size = KEY_SIZE * no_keys * no_layers
+		expected = HEADER.size + size + no_layers
+		if len(data) < expected:
+			raise ValueError("layout file truncated: %i keys and %i layers need %i bytes, got %i" %
+					(no_keys, no_layers, expected, len(data)))
+		elif len(data) > expected:
+			raise ValueError("layout file has %i bytes of trailing data" % (len(data) - expected))
+		parents = list(map(as_signed, data[HEADER.size + size:]))
+		check_parents(parents)
 		l = Layout()
-		l.no_keys, l.no_layers, *rest = data
-		lay_size = 4 * l.no_keys
-		layers = [rest[i*lay_size:(i+1)*lay_size] for i in range(0, l.no_layers)]
-		l.parents = rest[l.no_layers*lay_size:l.no_layers*lay_size + l.no_layers]
-		l.parents = list(map(as_signed, l.parents))
-		l.layers = []
-		for li, lay in enumerate(layers):
-			layer = []
-			binlay = [lay[i*4:(i+1)*4] for i in range(0, l.no_keys)]
-			for i, binkd in enumerate(binlay):
-				if all(map(lambda x: x == 0xff, binkd)):
-					kd = KeyDef(layout = l, layer = li, no = i, inherited = True)
-				else:
-					pr = Action(binkd[1] >> 4, as_signed(binkd[2]))
-					re = Action(binkd[1] & 0x0f, as_signed(binkd[3]))
-					kd = KeyDef(layout = l, layer = li, no = i,
-							scancode = binkd[0], press = pr, release = re)
-				layer.append(kd)
-			l.layers.append(layer)
+		l.no_keys, l.no_layers = no_keys, no_layers
+		l._data = bytearray(data[HEADER.size:HEADER.size + size])
+		# setting parents builds the root table
+		l.parents = parents
+		if -1 in l._roots:
+			lay, key = divmod(l._roots.index(-1), no_keys)
+			raise ValueError("key %i on layer %i is inherited, but none of the layers it inherits from defines it" %
+					(key, lay))
 		return l
@@ -0,0 +1,152 @@
+import math
+
+# Receives measurements from a UKBDC session (see UKBDC.metrics). Times are in
+# seconds. This one drops everything; UKBDC doesn't even take the time
+# measurements while the sink is not enabled, so it costs nothing.
+class NullMetrics(object):
+	enabled = False
+
+	# a packet was written to / read from the device
+	def packet_written(self, size, elapsed):
+		pass
+
+	def packet_read(self, size, elapsed):
+		pass
+
+	# a Ping was answered with status
+	def status_seen(self, status):
+		pass
+
+	# all packets of a message (name is its class name) were written
+	def message_sent(self, name, size, elapsed):
+		pass
+
+	# the device finished executing a message with status after polls Pings
+	def executed(self, name, status, elapsed, polls):
+		pass
+
+	# program_layout wrote pages pages (size bytes) in elapsed seconds
+	def programmed(self, size, pages, elapsed):
+		pass
+
+# Histogram with logarithmic buckets: bucket i counts values in
+# [base * 2**(i/steps), base * 2**((i+1)/steps))
+class Histogram(object):
+	def __init__(self, base = 1e-6, steps = 4):
+		self.base = base
+		self.steps = steps
+		self.buckets = {}
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+
+	def add(self, value):
+		if value <= self.base:
+			i = 0
+		else:
+			i = int(math.log2(value / self.base) * self.steps)
+		self.buckets[i] = self.buckets.get(i, 0) + 1
+		self.count += 1
+		self.total += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	# approximate value below which fraction q of the values fall
+	def quantile(self, q):
+		if self.count == 0:
+			return None
+		seen = 0
+		for i in sorted(self.buckets):
+			seen += self.buckets[i]
+			if seen >= q * self.count:
+				return min(self.base * 2 ** ((i + 1) / self.steps), self.max)
+
+	def as_dict(self):
+		return {
+			"count": self.count,
+			"sum": self.total,
+			"min": self.min,
+			"max": self.max,
+			"p50": self.quantile(0.5),
+			"p99": self.quantile(0.99),
+			# lower bound of the bucket -> count
+			"buckets": dict(("%.3g" % (self.base * 2 ** (i / self.steps)), n)
+					for i, n in sorted(self.buckets.items())),
+		}
+
+# Collects counters and histograms of everything reported by the sessions it
+# is given to; it can be shared by sessions running in several threads.
+class MetricsRecorder(NullMetrics):
+	enabled = True
+
+	def __init__(self):
+		# imported here, as ukbdc.py loads this module for NullMetrics
+		import threading
+		self._lock = threading.Lock()
+		self.counters = {}
+		self.statuses = {}
+		self.histograms = {}
+
+	def _count(self, name, n = 1):
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	def _add(self, name, value, base = 1e-6):
+		if name not in self.histograms:
+			self.histograms[name] = Histogram(base)
+		self.histograms[name].add(value)
+
+	def packet_written(self, size, elapsed):
+		with self._lock:
+			self._count("packets_written")
+			self._count("bytes_written", size)
+			self._add("packet_write", elapsed)
+
+	def packet_read(self, size, elapsed):
+		with self._lock:
+			self._count("packets_read")
+			self._count("bytes_read", size)
+			self._add("packet_read", elapsed)
+
+	def status_seen(self, status):
+		with self._lock:
+			self._count("pings")
+			self.statuses[status] = self.statuses.get(status, 0) + 1
+
+	def message_sent(self, name, size, elapsed):
+		with self._lock:
+			self._count("messages")
+			self._count("message_bytes", size)
+			self._add("send:" + name, elapsed)
+
+	def executed(self, name, status, elapsed, polls):
+		with self._lock:
+			self._add("execute:" + name, elapsed)
+			self._add("polls:" + name, polls, base = 1)
+
+	def programmed(self, size, pages, elapsed):
+		with self._lock:
+			self._count("layouts_programmed")
+			self._count("pages_programmed", pages)
+			self._add("program_layout", elapsed)
+			if elapsed > 0:
+				self._add("program_bytes_per_s", size / elapsed, base = 1)
+
+	def as_dict(self):
+		from .ukbdc import Status
+		with self._lock:
+			return {
+				"counters": dict(self.counters),
+				# Status codes seen, by name
+				"statuses": dict((Status.name(st) or str(st), n)
+						for st, n in self.statuses.items()),
+				"histograms": dict((name, h.as_dict())
+						for name, h in sorted(self.histograms.items())),
+			}
+
+	def dump(self, fname):
+		import json
+		with open(fname, "w") as f:
+			json.dump(self.as_dict(), f, indent = 1, sort_keys = True)
@@ -1,3 +1,5 @@
+from bisect import bisect_left
+
 mnemonics = {
 		4:	"a",
 		5:	"b",
@@ -143,3 +145,25 @@ mnemonics = {
 }
 
 scancodes = {v:k for k, v in mnemonics.items()}
+
+# Prefix completion of mnemonics over a sorted list. Each call narrows down
+# the range found by the previous one if the prefix was extended.
+class Completer(object):
+	def __init__(self, names = None):
+		if names is None:
+			names = scancodes.keys()
+		self.names = sorted(names)
+		self._prefix, self._lo, self._hi = "", 0, len(self.names)
+
+	def complete(self, prefix):
+		if prefix.startswith(self._prefix):
+			lo, hi = self._lo, self._hi
+		else:
+			lo, hi = 0, len(self.names)
+		lo = bisect_left(self.names, prefix, lo, hi)
+		if len(prefix) > 0:
+			# first string greater than all strings starting with prefix
+			upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+			hi = bisect_left(self.names, upper, lo, hi)
+		self._prefix, self._lo, self._hi = prefix, lo, hi
+		return self.names[lo:hi]
@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from .ukbdc import UKBDC
+
+class ProgramResult(object):
+	def __init__(self, device_id = None, skipped = 0, error = None, elapsed = 0.0):
+		self.device_id = device_id
+		self.skipped = skipped
+		self.error = error
+		self.elapsed = elapsed
+
+	@property
+	def ok(self):
+		return self.error is None
+
+def _program_one(dev, data, full, images, metrics, cancel):
+	res = ProgramResult()
+	start = time.monotonic()
+	u = UKBDC(images = images, metrics = metrics)
+	try:
+		u.attach(dev)
+		res.device_id = u.device_id
+		res.skipped = u.program_layout(data, full = full, cancel = cancel)
+	except Exception as e:
+		res.error = e
+		if res.device_id is None and u.transport is not None:
+			try:
+				res.device_id = u.device_id
+			except Exception:
+				pass
+	finally:
+		# attach() may fail after the interface is claimed
+		if u.transport is not None:
+			try:
+				u.detach()
+			except Exception as e:
+				if res.error is None:
+					res.error = e
+	res.elapsed = time.monotonic() - start
+	return res
+
+# Programs the layout image to all attached devices in parallel, one session
+# per device. Returns a ProgramResult for every device found; errors are
+# reported in the results instead of being raised. All sessions report to
+# metrics, if given. progress(done, total) is called, from the sessions'
+# threads, as devices are finished; cancel (a threading.Event) stops the
+# sessions still programming, as in UKBDC.program_layout.
+def program_all(data, full = False, workers = None, images = None, metrics = None,
+		progress = None, cancel = None):
+	devs = UKBDC.find_all()
+	if len(devs) == 0:
+		return []
+	if workers is None:
+		workers = len(devs)
+	lock = threading.Lock()
+	finished = [0]
+	def run(dev):
+		res = _program_one(dev, data, full, images, metrics, cancel)
+		if progress is not None:
+			with lock:
+				finished[0] += 1
+				progress(finished[0], len(devs))
+		return res
+	with ThreadPoolExecutor(max_workers = workers) as pool:
+		return list(pool.map(run, devs))
@@ -0,0 +1,59 @@
+import usb
+
+# A transport carries packets between UKBDC and a device. It has to provide:
+#   packet_size - maximum size of a packet written to the device
+#   device_id   - string identifying the device
+#   write(data, timeout) - writes one packet
+#   read(timeout)        - reads one packet, returns a sequence of ints
+#   close()
+# Timeouts are in milliseconds.
+
+class UsbTransport(object):
+	def __init__(self, dev, interface):
+		self.dev = dev
+		self.interface = interface
+		try:
+			usb.util.claim_interface(self.dev, self.interface)
+		except usb.core.USBError:
+			self.dev.detach_kernel_driver(self.interface)
+		config = self.dev[0]
+		iface = None
+		for i in config:
+			if i.bInterfaceNumber == self.interface:
+				iface = i
+		if not iface:
+			raise RuntimeError("Interface number {} not found".format(self.interface))
+		self.epin = usb.util.find_descriptor(iface, custom_match = \
+				lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == \
+					usb.util.ENDPOINT_IN)
+		self.epout = usb.util.find_descriptor(iface, custom_match = \
+				lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == \
+					usb.util.ENDPOINT_OUT)
+
+	@property
+	def packet_size(self):
+		return self.epout.wMaxPacketSize
+
+	# the serial number of the device if it has one,
+	# otherwise the bus and port path it is plugged into
+	@property
+	def device_id(self):
+		try:
+			serial = self.dev.serial_number
+		except (ValueError, usb.core.USBError):
+			serial = None
+		if serial:
+			return "serial-%s" % serial
+		ports = getattr(self.dev, "port_numbers", None) or [self.dev.address]
+		return "bus-%i-%s" % (self.dev.bus, ".".join(map(str, ports)))
+
+	def write(self, data, timeout):
+		self.epout.write(data, timeout = timeout)
+
+	def read(self, timeout):
+		return self.epin.read(self.epin.wMaxPacketSize, timeout = timeout)
+
+	def close(self):
+		usb.util.release_interface(self.dev, self.interface)
+		self.epin = None
+		self.epout = None
@@ -1,12 +1,20 @@
-import usb
-from .crc16 import crc16
+from .crc16 import CRC16
+from .layout import PAGE_SIZE
+from .metrics import NullMetrics
 import time
-from ctypes import c_uint16, c_uint8
+import os
+from collections import deque
+import struct
 
 class Packet(object):
 	def __init__(self, hdr, payload = b''):
 		self.hdr = bytes([hdr])
 		self.payload = bytes(payload)
+		# encoded packet
+		self.raw = self.hdr + self.payload
+
+	def __bytes__(self):
+		return self.raw
 
 	def __len__(self):
 		return 1 + len(self.payload)
@@ -32,30 +40,55 @@ class Cont(Packet):
 	def __init__(self, payload):
 		super(Cont, self).__init__(0x03, payload)
 
+# A message is framed into packets once per packet size: the Start packet
+# (length, crc16 and the beginning of the message) and Cont packets are laid
+# out in a single buffer and iterating yields memoryviews of that buffer
 class Message(object):
+	START = 0x02
+	CONT  = 0x03
+
 	def __init__(self, hdr, payload = b''):
 		self.hdr = bytes([hdr])
 		self.payload = bytes(payload)
 		self.psize = None
+		self._frame_psize = None
+		self._packets = None
 
 	def set_packet_size(self, psize):
 		self.psize = psize
 
 	def __len__(self):
 		return 1 + len(self.payload)
-		if self.psize is None:
-			raise RuntimeError("psize not set!")
+
+	def _frame(self, psize):
+		n = len(self)
+		first = min(n, psize - 4)
+		ncont = (n - first + psize - 2) // (psize - 1)
+		buf = bytearray(4 + ncont + n)
+		buf[0] = self.START
+		buf[1] = n & 0xff
+		buf[4] = self.hdr[0]
+		buf[5:4+first] = self.payload[:first-1]
+		buf[2:4] = struct.pack("<H", CRC16(self.hdr).update(self.payload).digest())
+		mv = memoryview(buf)
+		packets = [mv[0:4+first]]
+		pos, off = 4 + first, first - 1
+		for i in range(0, ncont):
+			chunk = min(psize - 1, len(self.payload) - off)
+			buf[pos] = self.CONT
+			buf[pos+1:pos+1+chunk] = self.payload[off:off+chunk]
+			packets.append(mv[pos:pos+1+chunk])
+			pos += 1 + chunk
+			off += chunk
+		return packets
 
 	def __iter__(self):
 		if self.psize is None:
 			raise RuntimeError("psize not set!")
-		msg = self.hdr + self.payload
-		fst = msg[0:self.psize - 4]
-		rest = [msg[i:i+self.psize-1] for i in range(self.psize - 4, len(msg), self.psize - 1)]
-		payload = bytes(c_uint8(len(self))) + bytes(c_uint16(crc16(msg))) + fst
-		yield Start(payload)
-		for c in rest:
-			yield Cont(c)
+		if self._frame_psize != self.psize:
+			self._packets = self._frame(self.psize)
+			self._frame_psize = self.psize
+		return iter(self._packets)
 
 class Dfu(Message):
 	def __init__(self):
@@ -63,11 +96,11 @@ class Dfu(Message):
 
 class WritePage(Message):
 	def __init__(self, page_addr, page):
-		if len(page) < 128:
-			page += bytes([0] * (128-len(page)))
-		elif len(page) > 128:
+		if len(page) < PAGE_SIZE:
+			page += bytes([0] * (PAGE_SIZE-len(page)))
+		elif len(page) > PAGE_SIZE:
 			raise ValueError("page too long")
-		payload = bytes(c_uint8(page_addr)) + page
+		payload = bytes([page_addr & 0xff]) + page
 		super(WritePage, self).__init__(0x01, payload)
 
 class ActivateLayout(Message):
@@ -107,6 +140,72 @@ class Status(object):
 		elif st == self.WRONG_MESSAGE_ERROR:
 			return "unknown message received"
 
+class ExecuteTimeout(RuntimeError):
+	pass
+
+class Cancelled(RuntimeError):
+	pass
+
+# How to poll the device while it executes a message: the first poll is
+# immediate, then the delay between polls starts at delay and is multiplied
+# by factor up to cap. ExecuteTimeout is raised if the device is still
+# executing after deadline seconds.
+class Polling(object):
+	def __init__(self, delay = 0.0005, factor = 2.0, cap = 0.02, deadline = 10.0):
+		self.delay = delay
+		self.factor = factor
+		self.cap = cap
+		self.deadline = deadline
+
+# Remembers the last layout image programmed to each device, so that only
+# the pages which differ have to be written next time. If path is given,
+# images are kept there as files and survive between runs.
+class ProgrammedImages(object):
+	def __init__(self, path = None):
+		self.path = path
+		self._images = {}
+
+	def _filename(self, dev_id):
+		name = "".join(map(lambda c: c if c.isalnum() or c in "-_." else "_", dev_id))
+		return os.path.join(self.path, name + ".bin")
+
+	def get(self, dev_id):
+		if dev_id in self._images or self.path is None:
+			return self._images.get(dev_id)
+		try:
+			with open(self._filename(dev_id), "rb") as f:
+				self._images[dev_id] = f.read()
+		except FileNotFoundError:
+			return None
+		return self._images[dev_id]
+
+	def set(self, dev_id, image):
+		self._images[dev_id] = bytes(image)
+		if self.path is not None:
+			os.makedirs(self.path, exist_ok = True)
+			fname = self._filename(dev_id)
+			with open(fname + ".tmp", "wb") as f:
+				f.write(image)
+			os.replace(fname + ".tmp", fname)
+
+	def forget(self, dev_id):
+		self._images.pop(dev_id, None)
+		if self.path is not None:
+			try:
+				os.remove(self._filename(dev_id))
+			except FileNotFoundError:
+				pass
+
+# State of a layout upload, between the steps of UKBDC.program_layout
+class Upload(object):
+	def __init__(self, data, pages, changed, start):
+		self.data = data
+		self.pages = pages
+		# numbers of the pages to be written
+		self.changed = changed
+		# time.perf_counter() when the upload started
+		self.start = start
+
 class UKBDC(object):
 	vendorId = 0x16c0
 	productId = 0x047c
@@ -114,82 +213,223 @@ class UKBDC(object):
 	ep_out = 0x03
 	ep_in = 0x82
 	tm_out = 1000
-	def __init__(self):
-		self.dev = None
-		pass
-
-	def attach(self):
-		self.dev = usb.core.find(
-				idVendor = self.vendorId,
-				idProduct = self.productId
-		)
-		if self.dev is None:
-			raise RuntimeError("no device found")
-		try:
-			usb.util.claim_interface(self.dev, self.interface)
-		except usb.core.USBError:
-			self.dev.detach_kernel_driver(self.interface)
-		config = self.dev[0]
-		iface = None
-		for i in config:
-                        if i.bInterfaceNumber == self.interface:
-                                iface = i
-		if not iface:
-                        raise RuntimeError("Interface number {} not found".format(self.interface))
-		self.epin = usb.util.find_descriptor(iface, custom_match = \
-				lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == \
-					usb.util.ENDPOINT_IN)
-		self.epout = usb.util.find_descriptor(iface, custom_match = \
-				lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == \
-					usb.util.ENDPOINT_OUT)
+	# shared by all sessions unless a different one is passed to the constructor
+	images = ProgrammedImages()
+	# default polling, and polling overrides by message class name
+	polling = Polling()
+	message_polling = {}
+	# how many execution times to remember per message type
+	exec_history = 100
+	# receives transfer measurements (see metrics.py), nothing is measured by default
+	metrics = NullMetrics()
+	def __init__(self, images = None, metrics = None):
+		self.transport = None
+		self._pending = False
+		self._executing = None
+		# message class name -> recent execution times in seconds
+		self.exec_times = {}
+		if images is not None:
+			self.images = images
+		if metrics is not None:
+			self.metrics = metrics
+
+	# all connected devices matching vendorId and productId
+	@classmethod
+	def find_all(cls):
+		import usb.core
+		return list(usb.core.find(
+				find_all = True,
+				idVendor = cls.vendorId,
+				idProduct = cls.productId
+		))
+
+	# Attaches to dev (one of find_all()), or the first device found.
+	# Instead of an USB device, a transport (see transport.py) can be given.
+	def attach(self, dev = None, transport = None):
+		if transport is None:
+			# pyusb is loaded only when a real device is used
+			import usb.core
+			from .transport import UsbTransport
+			if dev is None:
+				dev = usb.core.find(
+						idVendor = self.vendorId,
+						idProduct = self.productId
+				)
+			if dev is None:
+				raise RuntimeError("no device found")
+			transport = UsbTransport(dev, self.interface)
+		self.transport = transport
 		self.reset()
 
+	@property
+	def device_id(self):
+		if self.transport is None:
+			raise RuntimeError("device not attached")
+		return self.transport.device_id
+
 	def detach(self):
-		usb.util.release_interface(self.dev, self.interface)
-		self.epin = None
-		self.epout = None
+		self._pending = False
+		self.transport.close()
+		self.transport = None
 
 	def write_packet(self, p):
-		if len(p) > self.epout.wMaxPacketSize:
+		if self.transport is None:
+			raise RuntimeError("device not attached")
+		elif len(p) > self.transport.packet_size:
 			raise OverflowError("packet length > bMaxPacketSize")
-		elif self.dev is not None:
-			self.epout.write(bytes(p), timeout = self.tm_out)
 		else:
-			raise RuntimeError("device not attached")
+			if isinstance(p, Packet):
+				p = p.raw
+			if not self.metrics.enabled:
+				self.transport.write(p, timeout = self.tm_out)
+				return
+			start = time.perf_counter()
+			self.transport.write(p, timeout = self.tm_out)
+			self.metrics.packet_written(len(p), time.perf_counter() - start)
 
 	def read_packet(self):
-		if self.dev is not None:
-			return self.epin.read(self.epin.wMaxPacketSize, timeout = self.tm_out)
-		else:
+		if self.transport is None:
 			raise RuntimeError("device not attached")
+		if not self.metrics.enabled:
+			return self.transport.read(timeout = self.tm_out)
+		start = time.perf_counter()
+		p = self.transport.read(timeout = self.tm_out)
+		self.metrics.packet_read(len(p), time.perf_counter() - start)
+		return p
 
 	def status(self):
 		self.write_packet(Ping())
-		return self.read_packet()[1]
+		s = self.read_packet()[1]
+		if self.metrics.enabled:
+			self.metrics.status_seen(s)
+		return s
 
 	def reset(self):
 		self.write_packet(Reset())
 
-	def send(self, msg):
-		msg.set_packet_size(self.epout.wMaxPacketSize)
+	# Sends a message and waits until the device executes it. If pipelined
+	# is True, returns right after the packets are written and the result
+	# is checked only before the next message is started (the device holds
+	# one message at a time), or by an explicit call to complete().
+	def send(self, msg, pipelined = False):
+		self.complete()
+		msg.set_packet_size(self.transport.packet_size)
+		start = time.perf_counter()
 		for packet in msg:
 			self.write_packet(packet)
-		self.wait_end_execute()
+		if self.metrics.enabled:
+			self.metrics.message_sent(type(msg).__name__, len(msg), time.perf_counter() - start)
+		self._pending = True
+		self._executing = type(msg).__name__
+		if not pipelined:
+			return self.wait_end_execute()
 
-	def wait_end_execute(self):
-		while self.status() == Status.EXECUTING:
-			pass
+	# Waits for a pipelined message to be executed, raises if it failed
+	def complete(self):
+		if not self._pending:
+			return
+		s = self.wait_end_execute()
+		if s != Status.IDLE:
+			raise RuntimeError("device returned status: %s" % Status.name(s))
 
+	def wait_end_execute(self, polling = None):
+		if polling is None:
+			polling = self.message_polling.get(self._executing, self.polling)
+		start = time.monotonic()
+		deadline = start + polling.deadline
+		delay = polling.delay
+		polls = 1
+		s = self.status()
+		while s == Status.EXECUTING:
+			now = time.monotonic()
+			if now >= deadline:
+				name, self._executing = self._executing, None
+				self._pending = False
+				raise ExecuteTimeout("device still executing %s after %g s" %
+						(name or "message", polling.deadline))
+			time.sleep(min(delay, deadline - now))
+			delay = min(delay * polling.factor, polling.cap)
+			polls += 1
+			s = self.status()
+		if self._executing is not None:
+			elapsed = time.monotonic() - start
+			times = self.exec_times.setdefault(self._executing, deque(maxlen = self.exec_history))
+			times.append(elapsed)
+			if self.metrics.enabled:
+				self.metrics.executed(self._executing, s, elapsed, polls)
+		self._pending = False
+		self._executing = None
+		return s
+
+	# Flashing firmware replaces the layout on the device as well
 	def dfu(self):
+		self.images.forget(self.device_id)
 		self.send(Dfu())
 
-	def program_layout(self, data):
-		self.send(DeactivateLayout())
-		pages = [data[i:i+128] for i in range(0, len(data), 128)]
-		for no, page in enumerate(pages):
-			m = WritePage(no, page)
-			self.send(m)
-			s = self.status()
-			if s != Status.IDLE:
-				raise RuntimeError("device returned status: %s" % Status.name(s))
-		self.send(ActivateLayout())
+	# Splits the layout image into pages, returns them together with the
+	# numbers of pages which differ from the image last programmed to the
+	# device (all of them if full is True or the image is not known)
+	def changed_pages(self, data, full = False):
+		prev = None if full else self.images.get(self.device_id)
+		pages = [data[i:i+PAGE_SIZE] for i in range(0, len(data), PAGE_SIZE)]
+		if prev is None or len(prev) != len(data):
+			changed = list(range(0, len(pages)))
+		else:
+			changed = [no for no, page in enumerate(pages)
+					if page != prev[no*PAGE_SIZE:(no+1)*PAGE_SIZE]]
+		return pages, changed
+
+	# Writes the layout image to the device. Unless full is True, only the pages
+	# which differ from the image last programmed to this device are written.
+	# Returns the number of pages skipped.
+	# progress(done, total) is called as pages are written. If cancel (e.g. a
+	# threading.Event) gets set, Cancelled is raised before the next message,
+	# leaving the layout deactivated.
+	def program_layout(self, data, full = False, progress = None, cancel = None):
+		upload = self.begin_upload(data, full)
+		total = len(upload.changed)
+		if total == 0:
+			return len(upload.pages)
+		if progress is not None:
+			progress(0, total)
+		for i in range(0, total):
+			if cancel is not None and cancel.is_set():
+				self.complete()
+				raise Cancelled("programming cancelled")
+			self.upload_page(upload, i)
+			if progress is not None:
+				progress(i + 1, total)
+		return self.finish_upload(upload)
+
+	# The steps of program_layout, for callers which run them one at a time
+	# (see aio.py).
+
+	# Finds the pages to be written and, if there are any, deactivates the
+	# layout on the device
+	def begin_upload(self, data, full = False):
+		start = time.perf_counter()
+		pages, changed = self.changed_pages(data, full)
+		upload = Upload(data, pages, changed, start)
+		if len(upload.changed) > 0:
+			# the device contents are unknown until programming succeeds
+			self.images.forget(self.device_id)
+			self.send(DeactivateLayout(), pipelined = True)
+			self.complete()
+		return upload
+
+	# Writes the i-th of the changed pages (pipelined)
+	def upload_page(self, upload, i):
+		no = upload.changed[i]
+		self.send(WritePage(no, upload.pages[no]), pipelined = True)
+
+	# Activates the layout once all changed pages are written, returns the
+	# number of pages skipped. The image is remembered only once the device
+	# has activated it.
+	def finish_upload(self, upload):
+		self.send(ActivateLayout(), pipelined = True)
+		self.complete()
+		self.images.set(self.device_id, upload.data)
+		if self.metrics.enabled:
+			self.metrics.programmed(sum(len(upload.pages[no]) for no in upload.changed),
+					len(upload.changed), time.perf_counter() - upload.start)
+		return len(upload.pages) - len(upload.changed)